@@ -1,15 +1,42 @@
-from flask import Flask, render_template, request, jsonify, send_file, Response, g, after_this_request
+from flask import Flask, render_template, request, jsonify, Response, g, after_this_request, has_app_context
 import sqlite3
 import requests
 import json
 import folium
 import os
 import pandas as pd
+import numpy as np
+import zlib
+import gzip
+import hashlib
+import uuid
+import html
+import math
+import base64
+import io
 from datetime import datetime, timedelta
-import tempfile
 import shutil
 import csv
-from functools import wraps
+import time
+import re
+import random
+import threading
+import queue
+import heapq
+import unicodedata
+import cProfile
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import wraps, partial
+from requests.adapters import HTTPAdapter
+
+# Parquet/Arrow export is optional
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 
 app = Flask(__name__)
@@ -19,12 +46,165 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 from dotenv import load_dotenv
 load_dotenv()
 
+DATABASE_PATH = os.getenv("DATABASE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routes.db'))
+
+# SQLite connection tuning (cache size in KiB, mmap size in bytes)
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "30"))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", "256"))
+
+# Online backups copy BACKUP_PAGES_PER_STEP pages at a time; BACKUP_KEEP
+# newest files are kept in uploads/backups (0 keeps everything)
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "1024"))
+BACKUP_COMPRESS = os.getenv("BACKUP_COMPRESS", "0").lower() in ('1', 'true', 'yes')
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "10"))
+BACKUP_FILE_PATTERN = re.compile(r'^routes_backup_[0-9_]+\.db(\.gz)?$')
+
 OPENCAGE_API_KEY = os.getenv("OPENCAGE_API_KEY")
 GRAPHHOPPER_API_KEY = os.getenv("GRAPHHOPPER_API_KEY")
+OPENCAGE_URL = os.getenv("OPENCAGE_URL", "https://api.opencagedata.com/geocode/v1/json")
+GRAPHHOPPER_URL = os.getenv("GRAPHHOPPER_URL", "https://graphhopper.com/api/1/route")
+GRAPHHOPPER_MATRIX_URL = os.getenv("GRAPHHOPPER_MATRIX_URL", "https://graphhopper.com/api/1/matrix")
+
+# Routing backend: 'graphhopper' (API) or 'local' (in-process, over ROAD_GRAPH_FILE,
+# an edge-list CSV or an .osm XML extract). ROAD_GRAPH_CONTRACT=1 adds
+# contraction-hierarchy preprocessing for faster queries.
+ROUTING_BACKEND = os.getenv("ROUTING_BACKEND", "graphhopper")
+ROAD_GRAPH_FILE = os.getenv("ROAD_GRAPH_FILE", "")
+ROAD_GRAPH_CONTRACT = os.getenv("ROAD_GRAPH_CONTRACT", "0").lower() in ('1', 'true', 'yes')
+ROAD_GRAPH_SNAP_KM = float(os.getenv("ROAD_GRAPH_SNAP_KM", "5"))
+ROAD_GRAPH_CELL = 0.01  # degrees per cell of the nearest-node grid
+OSM_CAR_HIGHWAYS = {'motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'unclassified', 'residential',
+                    'service', 'living_street', 'road', 'motorway_link', 'trunk_link', 'primary_link',
+                    'secondary_link', 'tertiary_link'}
+
+# Upload pipeline tuning
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "8"))
+UPLOAD_BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", "100"))
+UPLOAD_FLUSH_INTERVAL = float(os.getenv("UPLOAD_FLUSH_INTERVAL", "1.0"))
+
+# Address uploads run as background jobs; this many jobs run at once and
+# the rest wait in the queue
+IMPORT_JOB_WORKERS = int(os.getenv("IMPORT_JOB_WORKERS", "2"))
+IMPORT_JOB_KEEPALIVE = 15  # seconds between SSE keepalive comments
+
+# Matrix upload mode: destinations per matrix call, how many routes without
+# geometry each /get_map fetches full geometry for, and the initial delay
+# before a failed fetch is retried (doubled per failure, up to a day)
+MATRIX_BATCH_SIZE = int(os.getenv("MATRIX_BATCH_SIZE", "50"))
+LAZY_GEOMETRY_LIMIT = int(os.getenv("LAZY_GEOMETRY_LIMIT", "200"))
+LAZY_GEOMETRY_RETRY = float(os.getenv("LAZY_GEOMETRY_RETRY", "300"))
+
+# Bulk import (/import_routes): rows per transaction and errors echoed back
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+IMPORT_MAX_ERRORS = 100
+
+# route_points are stored as zlib-compressed int32 deltas of fixed-point
+# [lon, lat] pairs (1e-6 degree resolution), prefixed with a format marker
+GEOMETRY_FORMAT = b'RP1'
+GEOMETRY_SCALE = 1e6
+GEOMETRY_MIGRATION_BATCH = 500
+
+# Douglas-Peucker tolerances (degrees) for the simplified levels of detail
+# stored in geometry_lods; level 0 is the full route_points geometry. The map
+# picks the coarsest level that is still finer than a pixel MAP_LOD_ZOOM_HEADROOM
+# zoom levels below the requested zoom, so users can zoom in a little first.
+ROUTE_LOD_TOLERANCES = (0.0001, 0.001, 0.01, 0.05)
+MAP_DEFAULT_ZOOM = 4
+MAP_LOD_ZOOM_HEADROOM = int(os.getenv("MAP_LOD_ZOOM_HEADROOM", "4"))
+
+# Map cache: rendered HTML is reused until routes_changelog moves on. Up to
+# MAP_INCREMENTAL_LIMIT changed routes are patched into the cached per-route
+# layers; beyond that (or once the changelog has been pruned) it is rebuilt.
+MAP_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'cached_map.html')
+MAP_CACHE_META_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'map_last_update.txt')
+MAP_INCREMENTAL_LIMIT = int(os.getenv("MAP_INCREMENTAL_LIMIT", "1000"))
+MAP_CHANGELOG_KEEP = int(os.getenv("MAP_CHANGELOG_KEEP", "10000"))
+
+# Route table paging: ?sort= values mapped to the indexed sort expressions
+ROUTES_PAGE_SIZE = 100
+ROUTES_MAX_PAGE_SIZE = 1000
+ROUTE_SORT_COLUMNS = {
+    'date': "COALESCE(date, '')",
+    'distance': "COALESCE(distance, 0)",
+    'start': "start_address COLLATE NOCASE",
+    'end': "end_address COLLATE NOCASE"
+}
+
+# Columns available to /export_csv: name -> (SQL expression, CSV header)
+EXPORT_COLUMNS = {
+    'id': ('id', 'ID'),
+    'start_address': ('start_address', 'Start Address'),
+    'end_address': ('end_address', 'End Address'),
+    'distance': ('distance', 'Distance (km)'),
+    'date': ('date', 'Date'),
+    'notes': ('notes', 'Notes')
+}
+EXPORT_FORMATS = ('csv', 'parquet', 'arrow')
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+
+# Routes per start address listed by /get_statistics_breakdown
+STATISTICS_BREAKDOWN_LIMIT = int(os.getenv("STATISTICS_BREAKDOWN_LIMIT", "50"))
+
+# GeoJSON data API and vector tiles
+GEOJSON_PAGE_SIZE = 500
+GEOJSON_MAX_PAGE_SIZE = 5000
+TILE_MAX_ZOOM = 22
+TILE_BUFFER = 1 / 16  # fraction of a tile added on each side before clipping
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", "2000"))
+
+# Opt-in profiling: with PROFILE_REQUESTS=1, requests and upload jobs that
+# take at least PROFILE_SLOW_SECONDS are dumped as cProfile stats to PROFILE_DIR
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0").lower() in ('1', 'true', 'yes')
+PROFILE_SLOW_SECONDS = float(os.getenv("PROFILE_SLOW_SECONDS", "1.0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+
+# External API client tuning. Rate limits are requests per second; the
+# OpenCage free tier allows 1/s and GraphHopper's free tier roughly 1/s too.
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "30"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(max(10, UPLOAD_WORKERS))))
+OPENCAGE_RATE_LIMIT = float(os.getenv("OPENCAGE_RATE_LIMIT", "1"))
+GRAPHHOPPER_RATE_LIMIT = float(os.getenv("GRAPHHOPPER_RATE_LIMIT", "1"))
+
+# Geocode cache tuning (TTLs in seconds)
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", str(90 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = int(os.getenv("GEOCODE_NEGATIVE_TTL", str(24 * 3600)))
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "10000"))
+
+# Geocoding backend: 'opencage' (API) or 'local' (in-memory gazetteer from
+# GAZETTEER_FILE, falling back to OpenCage on a miss unless GAZETTEER_FALLBACK=0).
+# Fuzzy matches need GAZETTEER_MIN_SCORE of the query's trigrams when the
+# query has numbers (which the match must all contain), and that trigram
+# Dice similarity when it has none.
+GEOCODER_BACKEND = os.getenv("GEOCODER_BACKEND", "opencage")
+GAZETTEER_FILE = os.getenv("GAZETTEER_FILE", "")
+GAZETTEER_FALLBACK = os.getenv("GAZETTEER_FALLBACK", "1").lower() in ('1', 'true', 'yes')
+GAZETTEER_MIN_SCORE = float(os.getenv("GAZETTEER_MIN_SCORE", "0.85"))
+GAZETTEER_MAX_CANDIDATES = 5000
+GAZETTEER_ABBREVIATIONS = {
+    'street': 'st', 'avenue': 'ave', 'road': 'rd', 'drive': 'dr', 'boulevard': 'blvd', 'lane': 'ln',
+    'court': 'ct', 'place': 'pl', 'square': 'sq', 'highway': 'hwy', 'parkway': 'pkwy', 'terrace': 'ter',
+    'circle': 'cir', 'north': 'n', 'south': 's', 'east': 'e', 'west': 'w', 'apartment': 'apt',
+    'suite': 'ste', 'saint': 'st', 'mount': 'mt', 'fort': 'ft'
+}
+
+# Route cache tuning: coordinates are rounded to ROUTE_CACHE_PRECISION decimals
+# (4 decimals is roughly 11 m) and entries older than ROUTE_CACHE_TTL are stale
+ROUTE_CACHE_PRECISION = int(os.getenv("ROUTE_CACHE_PRECISION", "4"))
+ROUTE_CACHE_TTL = int(os.getenv("ROUTE_CACHE_TTL", str(30 * 24 * 3600)))
 
 def init_db():
-    conn = sqlite3.connect('routes.db')
+    conn = connect_db()
+    # WAL is persistent, so setting it once here covers every later connection
+    conn.execute("PRAGMA journal_mode = WAL")
     c = conn.cursor()
+    # routes.route_points is only read when migrating older databases;
+    # geometry now lives in route_geometry
     c.execute('''CREATE TABLE IF NOT EXISTS routes
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   start_address TEXT NOT NULL,
@@ -32,128 +212,2686 @@ def init_db():
                   distance REAL,
                   date TEXT,
                   notes TEXT,
-                  route_points TEXT)''')
+                  route_points BLOB)''')
+    # lat/lng are NULL for addresses the geocoder could not resolve
+    c.execute('''CREATE TABLE IF NOT EXISTS geocode_cache
+                 (address_key TEXT PRIMARY KEY,
+                  lat REAL,
+                  lng REAL,
+                  expires_at REAL NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS route_cache
+                 (route_key TEXT PRIMARY KEY,
+                  start_lat REAL NOT NULL,
+                  start_lng REAL NOT NULL,
+                  end_lat REAL NOT NULL,
+                  end_lng REAL NOT NULL,
+                  distance REAL NOT NULL,
+                  route_points BLOB NOT NULL,
+                  computed_at REAL NOT NULL)''')
+
+    # Older databases predate the route_key column
+    columns = [row[1] for row in c.execute("PRAGMA table_info(routes)")]
+    if 'route_key' not in columns:
+        c.execute("ALTER TABLE routes ADD COLUMN route_key TEXT")
+    for column in ('min_lon', 'min_lat', 'max_lon', 'max_lat', 'start_lon', 'start_lat', 'end_lon', 'end_lat'):
+        if column not in columns:
+            c.execute(f"ALTER TABLE routes ADD COLUMN {column} REAL")
+    if 'geometry_id' not in columns:
+        c.execute("ALTER TABLE routes ADD COLUMN geometry_id INTEGER")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_routes_route_key ON routes (route_key)")
+    # Routes stored with only their endpoints (matrix uploads, imports) whose
+    # geometry is fetched when the map first shows them
+    c.execute("DROP INDEX IF EXISTS idx_routes_pending_geometry")
+    # Routes whose geometry fetch failed, skipped until retry_at
+    c.execute('''CREATE TABLE IF NOT EXISTS geometry_fetch_failures
+                 (route_id INTEGER PRIMARY KEY,
+                  attempts INTEGER NOT NULL,
+                  retry_at REAL NOT NULL)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_routes_missing_geometry ON routes (id)
+                 WHERE geometry_id IS NULL AND start_lat IS NOT NULL''')
+    # Lets bulk imports skip rows that are already stored
+    c.execute("CREATE INDEX IF NOT EXISTS idx_routes_import_key ON routes (start_address, end_address, date)")
+
+    # Content-addressed geometry: identical route_points blobs (the same
+    # start/end pair routed again) are stored once and shared by reference.
+    # refcount is the number of routes using a row; triggers maintain it and
+    # drop rows, with their levels of detail, once nothing refers to them.
+    # The blob goes last so scans of hash/refcount skip its overflow pages.
+    c.execute('''CREATE TABLE IF NOT EXISTS route_geometry
+                 (id INTEGER PRIMARY KEY,
+                  hash BLOB NOT NULL UNIQUE,
+                  refcount INTEGER NOT NULL DEFAULT 0,
+                  route_points BLOB NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS geometry_lods
+                 (geometry_id INTEGER NOT NULL,
+                  level INTEGER NOT NULL,
+                  route_points BLOB NOT NULL,
+                  PRIMARY KEY (geometry_id, level)) WITHOUT ROWID''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS routes_geometry_insert AFTER INSERT ON routes
+                 WHEN NEW.geometry_id IS NOT NULL
+                 BEGIN
+                     UPDATE route_geometry SET refcount = refcount + 1 WHERE id = NEW.geometry_id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS routes_geometry_update AFTER UPDATE OF geometry_id ON routes
+                 WHEN OLD.geometry_id IS NOT NEW.geometry_id
+                 BEGIN
+                     UPDATE route_geometry SET refcount = refcount + 1 WHERE id = NEW.geometry_id;
+                     UPDATE route_geometry SET refcount = refcount - 1 WHERE id = OLD.geometry_id;
+                     DELETE FROM route_geometry WHERE id = OLD.geometry_id AND refcount <= 0;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS routes_geometry_delete AFTER DELETE ON routes
+                 WHEN OLD.geometry_id IS NOT NULL
+                 BEGIN
+                     UPDATE route_geometry SET refcount = refcount - 1 WHERE id = OLD.geometry_id;
+                     DELETE FROM route_geometry WHERE id = OLD.geometry_id AND refcount <= 0;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS route_geometry_delete_lods AFTER DELETE ON route_geometry
+                 BEGIN
+                     DELETE FROM geometry_lods WHERE geometry_id = OLD.id;
+                 END''')
+
+    # Every change that affects the map bumps the data version
+    c.execute('''CREATE TABLE IF NOT EXISTS routes_changelog
+                 (version INTEGER PRIMARY KEY AUTOINCREMENT,
+                  route_id INTEGER NOT NULL)''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS routes_log_insert AFTER INSERT ON routes
+                 BEGIN
+                     INSERT INTO routes_changelog (route_id) VALUES (NEW.id);
+                 END''')
+    # Recreated so databases from before route_geometry log geometry changes
+    c.execute("DROP TRIGGER IF EXISTS routes_log_update")
+    c.execute('''CREATE TRIGGER routes_log_update
+                 AFTER UPDATE OF start_address, end_address, geometry_id ON routes
+                 BEGIN
+                     INSERT INTO routes_changelog (route_id) VALUES (NEW.id);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS routes_log_delete AFTER DELETE ON routes
+                 BEGIN
+                     INSERT INTO routes_changelog (route_id) VALUES (OLD.id);
+                 END''')
+
+    # Keyset pagination indexes for /get_routes; expressions must match ROUTE_SORT_COLUMNS
+    for name, expression in (('date', "COALESCE(date, '')"), ('distance', "COALESCE(distance, 0)"),
+                             ('start', "start_address COLLATE NOCASE"), ('end', "end_address COLLATE NOCASE")):
+        c.execute(f"CREATE INDEX IF NOT EXISTS idx_routes_sort_{name} ON routes ({expression}, id)")
+
+    # Spatial indexes: each route's bounding box, and its start (id * 2) and
+    # end (id * 2 + 1) points, kept in sync with routes by triggers
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS routes_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat)")
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS route_endpoints_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat)")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS routes_rtree_insert AFTER INSERT ON routes
+                 WHEN NEW.min_lon IS NOT NULL
+                 BEGIN
+                     INSERT INTO routes_rtree VALUES (NEW.id, NEW.min_lon, NEW.max_lon, NEW.min_lat, NEW.max_lat);
+                     INSERT INTO route_endpoints_rtree VALUES
+                         (NEW.id * 2, NEW.start_lon, NEW.start_lon, NEW.start_lat, NEW.start_lat),
+                         (NEW.id * 2 + 1, NEW.end_lon, NEW.end_lon, NEW.end_lat, NEW.end_lat);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS routes_rtree_update
+                 AFTER UPDATE OF min_lon, min_lat, max_lon, max_lat, start_lon, start_lat, end_lon, end_lat ON routes
+                 BEGIN
+                     DELETE FROM routes_rtree WHERE id = OLD.id;
+                     DELETE FROM route_endpoints_rtree WHERE id IN (OLD.id * 2, OLD.id * 2 + 1);
+                     INSERT INTO routes_rtree SELECT NEW.id, NEW.min_lon, NEW.max_lon, NEW.min_lat, NEW.max_lat
+                         WHERE NEW.min_lon IS NOT NULL;
+                     INSERT INTO route_endpoints_rtree
+                         SELECT NEW.id * 2, NEW.start_lon, NEW.start_lon, NEW.start_lat, NEW.start_lat
+                         WHERE NEW.start_lon IS NOT NULL
+                         UNION ALL
+                         SELECT NEW.id * 2 + 1, NEW.end_lon, NEW.end_lon, NEW.end_lat, NEW.end_lat
+                         WHERE NEW.end_lon IS NOT NULL;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS routes_rtree_delete AFTER DELETE ON routes
+                 BEGIN
+                     DELETE FROM routes_rtree WHERE id = OLD.id;
+                     DELETE FROM route_endpoints_rtree WHERE id IN (OLD.id * 2, OLD.id * 2 + 1);
+                 END''')
+
+    # Materialized statistics, maintained by triggers. version bumps on every
+    # change so on-demand breakdowns can be cached until the next write.
+    c.execute('''CREATE TABLE IF NOT EXISTS routes_stats
+                 (id INTEGER PRIMARY KEY CHECK (id = 1),
+                  total_routes INTEGER NOT NULL,
+                  distance_count INTEGER NOT NULL,
+                  total_distance REAL NOT NULL,
+                  version INTEGER NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS routes_daily_stats
+                 (day TEXT PRIMARY KEY,
+                  route_count INTEGER NOT NULL,
+                  total_distance REAL NOT NULL)''')
+    # Routes without a date have no day bucket. Earlier versions of these
+    # triggers wrote NULL-day rows for them, so they are recreated each start
+    # and any such rows dropped.
+    c.execute("DELETE FROM routes_daily_stats WHERE day IS NULL")
+    c.execute("DROP TRIGGER IF EXISTS routes_stats_insert")
+    c.execute('''CREATE TRIGGER routes_stats_insert AFTER INSERT ON routes
+                 BEGIN
+                     UPDATE routes_stats
+                     SET total_routes = total_routes + 1,
+                         distance_count = distance_count + (NEW.distance IS NOT NULL),
+                         total_distance = total_distance + COALESCE(NEW.distance, 0),
+                         version = version + 1
+                     WHERE id = 1;
+                     INSERT INTO routes_daily_stats (day, route_count, total_distance)
+                     SELECT substr(NEW.date, 1, 10), 1, COALESCE(NEW.distance, 0) WHERE NEW.date IS NOT NULL
+                     ON CONFLICT (day) DO UPDATE
+                     SET route_count = route_count + 1, total_distance = total_distance + excluded.total_distance;
+                 END''')
+    c.execute("DROP TRIGGER IF EXISTS routes_stats_delete")
+    c.execute('''CREATE TRIGGER routes_stats_delete AFTER DELETE ON routes
+                 BEGIN
+                     UPDATE routes_stats
+                     SET total_routes = total_routes - 1,
+                         distance_count = distance_count - (OLD.distance IS NOT NULL),
+                         total_distance = total_distance - COALESCE(OLD.distance, 0),
+                         version = version + 1
+                     WHERE id = 1;
+                     UPDATE routes_daily_stats
+                     SET route_count = route_count - 1, total_distance = total_distance - COALESCE(OLD.distance, 0)
+                     WHERE day IS substr(OLD.date, 1, 10);
+                     DELETE FROM routes_daily_stats WHERE day IS substr(OLD.date, 1, 10) AND route_count <= 0;
+                 END''')
+    c.execute("DROP TRIGGER IF EXISTS routes_stats_update")
+    c.execute('''CREATE TRIGGER routes_stats_update
+                 AFTER UPDATE OF distance, date, start_address ON routes
+                 BEGIN
+                     UPDATE routes_stats
+                     SET distance_count = distance_count - (OLD.distance IS NOT NULL) + (NEW.distance IS NOT NULL),
+                         total_distance = total_distance - COALESCE(OLD.distance, 0) + COALESCE(NEW.distance, 0),
+                         version = version + 1
+                     WHERE id = 1;
+                     UPDATE routes_daily_stats
+                     SET route_count = route_count - 1, total_distance = total_distance - COALESCE(OLD.distance, 0)
+                     WHERE day IS substr(OLD.date, 1, 10);
+                     DELETE FROM routes_daily_stats WHERE day IS substr(OLD.date, 1, 10) AND route_count <= 0;
+                     INSERT INTO routes_daily_stats (day, route_count, total_distance)
+                     SELECT substr(NEW.date, 1, 10), 1, COALESCE(NEW.distance, 0) WHERE NEW.date IS NOT NULL
+                     ON CONFLICT (day) DO UPDATE
+                     SET route_count = route_count + 1, total_distance = total_distance + excluded.total_distance;
+                 END''')
+    if c.execute("SELECT COUNT(*) FROM routes_stats").fetchone()[0] == 0:
+        rebuild_route_statistics(conn)
+
+    # db_id tells versions of different database files apart (e.g. after a restore)
+    c.execute('''CREATE TABLE IF NOT EXISTS app_meta
+                 (key TEXT PRIMARY KEY,
+                  value TEXT)''')
+    c.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('db_id', ?)", (uuid.uuid4().hex,))
+
+    # Address upload jobs. Each destination is an item whose status is
+    # committed together with its route, so a restarted job skips done rows.
+    c.execute('''CREATE TABLE IF NOT EXISTS import_jobs
+                 (id TEXT PRIMARY KEY,
+                  start_address TEXT NOT NULL,
+                  mode TEXT NOT NULL DEFAULT 'route',
+                  status TEXT NOT NULL,
+                  total INTEGER NOT NULL,
+                  processed INTEGER NOT NULL DEFAULT 0,
+                  successful INTEGER NOT NULL DEFAULT 0,
+                  error TEXT,
+                  created_at REAL NOT NULL,
+                  updated_at REAL NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS import_job_items
+                 (job_id TEXT NOT NULL,
+                  line INTEGER NOT NULL,
+                  address TEXT NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'pending',
+                  error TEXT,
+                  route_id INTEGER,
+                  PRIMARY KEY (job_id, line)) WITHOUT ROWID''')
+    if 'mode' not in [row[1] for row in c.execute("PRAGMA table_info(import_jobs)")]:
+        c.execute("ALTER TABLE import_jobs ADD COLUMN mode TEXT NOT NULL DEFAULT 'route'")
     conn.commit()
+
+    migrate_route_points(conn)
+    backfill_route_extents(conn)
+    migrate_route_geometry(conn)
+    sync_spatial_index(conn)
     conn.close()
 
-def backup_database():
-    backup_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'backups')
-    os.makedirs(backup_dir, exist_ok=True)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_path = os.path.join(backup_dir, f'routes_backup_{timestamp}.db')
-    shutil.copy2('routes.db', backup_path)
-    return backup_path
+def encode_route_points(points):
+    # Accepts a list of [lon, lat] pairs or an (N, 2) array
+    coords = np.rint(np.asarray(points, dtype=np.float64).reshape(-1, 2) * GEOMETRY_SCALE).astype('<i4')
+    deltas = np.diff(coords, axis=0, prepend=np.zeros((1, 2), dtype='<i4'))
+    return GEOMETRY_FORMAT + zlib.compress(deltas.tobytes())
+
+def decode_route_points(value):
+    # Returns an (N, 2) float array of [lon, lat]; legacy JSON text is still accepted
+    if not value:
+        return np.empty((0, 2))
+    if isinstance(value, str):
+        return np.asarray(json.loads(value), dtype=np.float64).reshape(-1, 2)
+    value = bytes(value)
+    if not value.startswith(GEOMETRY_FORMAT):
+        raise ValueError('Unknown route_points format')
+    deltas = np.frombuffer(zlib.decompress(value[len(GEOMETRY_FORMAT):]), dtype='<i4').reshape(-1, 2)
+    return np.cumsum(deltas, axis=0, dtype=np.int64) / GEOMETRY_SCALE
+
+def simplify_route_points(points, tolerance):
+    # Iterative Douglas-Peucker; each segment's distances are computed in one
+    # vectorized pass. Endpoints are always kept.
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    if n < 3:
+        return points
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a = points[start]
+        direction = points[end] - a
+        offsets = points[start + 1:end] - a
+        length = np.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            split = start + 1 + i
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return points[keep]
+
+def build_route_lods(points):
+    # Returns [(level, encoded_points)], each level simplified from the previous one
+    lods = []
+    simplified = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    for level, tolerance in enumerate(ROUTE_LOD_TOLERANCES, 1):
+        simplified = simplify_route_points(simplified, tolerance)
+        lods.append((level, encode_route_points(simplified)))
+    return lods
+
+def store_geometry_lods(conn, geometry_id, lods):
+    conn.executemany("INSERT OR REPLACE INTO geometry_lods (geometry_id, level, route_points) VALUES (?, ?, ?)",
+                     [(geometry_id, level, route_points) for level, route_points in lods])
+
+def geometry_hash(route_points):
+    # Content address of an encoded geometry; encoding is deterministic, so
+    # the same path always hashes the same
+    return hashlib.sha256(route_points).digest()
+
+def store_route_geometry(conn, geometry):
+    # Returns the route_geometry id for the geometry's content, adding the
+    # row (and any levels of detail) the first time it is seen. New rows
+    # start unreferenced; the routes triggers count the references.
+    if geometry['route_points'] is None:
+        return None
+    # OR IGNORE rather than SELECT-then-INSERT: another connection may add
+    # the same hash in between
+    cursor = conn.execute("INSERT OR IGNORE INTO route_geometry (hash, route_points) VALUES (?, ?)",
+                          (geometry['hash'], geometry['route_points']))
+    geometry_id = conn.execute("SELECT id FROM route_geometry WHERE hash = ?", (geometry['hash'],)).fetchone()[0]
+    if cursor.rowcount == 1:
+        store_geometry_lods(conn, geometry_id, geometry['lods'])
+    return geometry_id
+
+def route_bbox(points):
+    # (min_lon, min_lat, max_lon, max_lat) of an (N, 2) [lon, lat] array
+    if not len(points):
+        return (None, None, None, None)
+    mins = points.min(axis=0)
+    maxs = points.max(axis=0)
+    return (float(mins[0]), float(mins[1]), float(maxs[0]), float(maxs[1]))
+
+def route_endpoints(points):
+    # (start_lon, start_lat, end_lon, end_lat)
+    if not len(points):
+        return (None, None, None, None)
+    return (float(points[0][0]), float(points[0][1]), float(points[-1][0]), float(points[-1][1]))
+
+def prepare_route_geometry(points):
+    # Everything the routes table derives from a route's geometry, computed
+    # once per write (and off the request thread during uploads). Geometry
+    # that is already stored keeps its levels of detail, so a repeated
+    # start/end pair skips the simplification work.
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    route_points = encode_route_points(points)
+    digest = geometry_hash(route_points)
+    known = get_db().execute("SELECT 1 FROM route_geometry WHERE hash = ?", (digest,)).fetchone()
+    return {
+        'route_points': route_points,
+        'hash': digest,
+        'bbox': route_bbox(points),
+        'endpoints': route_endpoints(points),
+        'lods': [] if known else build_route_lods(points)
+    }
+
+def endpoint_geometry(start_coords, end_coords):
+    # Stand-in for routes whose path isn't known yet: no points, but the
+    # bbox/endpoints still place the route in the spatial indexes
+    (start_lat, start_lng), (end_lat, end_lng) = start_coords, end_coords
+    return {
+        'route_points': None,
+        'hash': None,
+        'bbox': (min(start_lng, end_lng), min(start_lat, end_lat), max(start_lng, end_lng), max(start_lat, end_lat)),
+        'endpoints': (start_lng, start_lat, end_lng, end_lat),
+        'lods': []
+    }
+
+def insert_route(conn, start_address, end_address, distance, date, notes, route_key, geometry):
+    # date=None stamps the row with today's date
+    cursor = conn.execute("""INSERT INTO routes
+                             (start_address, end_address, distance, date, notes, geometry_id, route_key,
+                              min_lon, min_lat, max_lon, max_lat, start_lon, start_lat, end_lon, end_lat)
+                             VALUES (?, ?, ?, COALESCE(?, date('now')), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                          (start_address, end_address, distance, date, notes, store_route_geometry(conn, geometry),
+                           route_key, *geometry['bbox'], *geometry['endpoints']))
+    return cursor.lastrowid
+
+def update_route_geometry(conn, route_id, geometry):
+    conn.execute("""UPDATE routes
+                    SET geometry_id = ?, min_lon = ?, min_lat = ?, max_lon = ?, max_lat = ?,
+                        start_lon = ?, start_lat = ?, end_lon = ?, end_lat = ?
+                    WHERE id = ?""",
+                 (store_route_geometry(conn, geometry), *geometry['bbox'], *geometry['endpoints'], route_id))
+
+def zoom_to_lod(zoom, headroom=MAP_LOD_ZOOM_HEADROOM):
+    # Coarsest level whose tolerance stays under one pixel at the target zoom
+    pixel_degrees = 360 / (256 * 2 ** (zoom + headroom))
+    level = 0
+    for i, tolerance in enumerate(ROUTE_LOD_TOLERANCES, 1):
+        if tolerance <= pixel_degrees:
+            level = i
+    return level
+
+def rebuild_route_statistics(conn):
+    # Recompute the materialized aggregates from scratch (first run on an
+    # existing database, or to repair drift)
+    conn.execute("DELETE FROM routes_daily_stats")
+    conn.execute("""INSERT INTO routes_daily_stats (day, route_count, total_distance)
+                    SELECT substr(date, 1, 10), COUNT(*), COALESCE(SUM(distance), 0)
+                    FROM routes WHERE date IS NOT NULL GROUP BY substr(date, 1, 10)""")
+    conn.execute("""INSERT OR REPLACE INTO routes_stats (id, total_routes, distance_count, total_distance, version)
+                    SELECT 1, COUNT(*), COUNT(distance), COALESCE(SUM(distance), 0),
+                           COALESCE((SELECT version + 1 FROM routes_stats WHERE id = 1), 0)
+                    FROM routes""")
+    conn.commit()
+
+def backfill_route_extents(conn):
+    # Rows written before bounding boxes and endpoints were tracked
+    last_id = 0
+    while True:
+        rows = conn.execute("""SELECT id, route_points FROM routes
+                               WHERE start_lon IS NULL AND route_points IS NOT NULL AND id > ?
+                               ORDER BY id LIMIT ?""", (last_id, GEOMETRY_MIGRATION_BATCH)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for route_id, route_points in rows:
+            try:
+                points = decode_route_points(route_points)
+                updates.append((*route_bbox(points), *route_endpoints(points), route_id))
+            except (ValueError, zlib.error) as e:
+                print(f"Could not compute bounding box for route {route_id}: {e}")
+        conn.executemany("""UPDATE routes
+                              SET min_lon = ?, min_lat = ?, max_lon = ?, max_lat = ?,
+                                  start_lon = ?, start_lat = ?, end_lon = ?, end_lat = ?
+                              WHERE id = ?""", updates)
+        conn.commit()
+        last_id = rows[-1][0]
+
+def sync_spatial_index(conn):
+    # Index rows that predate the R-tree triggers
+    conn.execute("""INSERT INTO routes_rtree
+                    SELECT id, min_lon, max_lon, min_lat, max_lat FROM routes
+                    WHERE min_lon IS NOT NULL AND id NOT IN (SELECT id FROM routes_rtree)""")
+    conn.execute("""INSERT INTO route_endpoints_rtree
+                    SELECT id * 2, start_lon, start_lon, start_lat, start_lat FROM routes
+                    WHERE start_lon IS NOT NULL AND id * 2 NOT IN (SELECT id FROM route_endpoints_rtree)
+                    UNION ALL
+                    SELECT id * 2 + 1, end_lon, end_lon, end_lat, end_lat FROM routes
+                    WHERE end_lon IS NOT NULL AND id * 2 + 1 NOT IN (SELECT id FROM route_endpoints_rtree)""")
+    conn.commit()
+
+def migrate_route_points(conn):
+    # Convert JSON route_points left by older versions in place, in batches
+    converted = 0
+    for table, key in (('routes', 'id'), ('route_cache', 'route_key')):
+        while True:
+            rows = conn.execute(f"SELECT {key}, route_points FROM {table} WHERE typeof(route_points) = 'text' LIMIT ?",
+                                (GEOMETRY_MIGRATION_BATCH,)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row_key, route_points in rows:
+                try:
+                    updates.append((encode_route_points(decode_route_points(route_points)), row_key))
+                except (ValueError, TypeError) as e:
+                    print(f"Could not convert route_points for {table} {row_key}: {e}")
+                    updates.append((None, row_key))
+            conn.executemany(f"UPDATE {table} SET route_points = ? WHERE {key} = ?", updates)
+            conn.commit()
+            converted += len(updates)
+    if converted:
+        print(f"Converted {converted} route geometries to compact storage")
+        conn.execute("VACUUM")
+
+def migrate_route_geometry(conn):
+    # Move geometry stored on routes rows by older versions into
+    # route_geometry, one row per distinct blob, along with its levels of
+    # detail, then drop geometry nothing refers to any more
+    has_route_lods = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'route_lods'").fetchone() is not None
+    moved = 0
+    last_id = 0
+    while True:
+        rows = conn.execute("""SELECT id, route_points FROM routes WHERE route_points IS NOT NULL AND id > ?
+                               ORDER BY id LIMIT ?""", (last_id, GEOMETRY_MIGRATION_BATCH)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        for route_id, route_points in rows:
+            digest = geometry_hash(route_points)
+            conn.execute("INSERT OR IGNORE INTO route_geometry (hash, route_points) VALUES (?, ?)", (digest, route_points))
+            geometry_id = conn.execute("SELECT id FROM route_geometry WHERE hash = ?", (digest,)).fetchone()[0]
+            if has_route_lods:
+                conn.execute("""INSERT OR IGNORE INTO geometry_lods (geometry_id, level, route_points)
+                                SELECT ?, level, route_points FROM route_lods WHERE route_id = ?""",
+                             (geometry_id, route_id))
+            conn.execute("UPDATE routes SET geometry_id = ?, route_points = NULL WHERE id = ?", (geometry_id, route_id))
+        conn.commit()
+        moved += len(rows)
+    if has_route_lods:
+        conn.execute("DROP TRIGGER IF EXISTS routes_delete_lods")
+        conn.execute("DROP TABLE route_lods")
+    conn.execute("DELETE FROM route_geometry WHERE refcount <= 0")
+    conn.commit()
+    if moved:
+        stored = conn.execute("SELECT COUNT(*) FROM route_geometry").fetchone()[0]
+        print(f"Moved geometry of {moved} routes into {stored} shared rows")
+        conn.execute("VACUUM")
+
+def get_backup_dir():
+    backup_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'backups')
+    os.makedirs(backup_dir, exist_ok=True)
+    return backup_dir
+
+def new_backup_path(compress=BACKUP_COMPRESS):
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    return os.path.join(get_backup_dir(), f'routes_backup_{timestamp}.db' + ('.gz' if compress else ''))
+
+def open_backup_snapshot():
+    # A read transaction pins what the backup will contain. Under WAL it does
+    # not block writers, and because every step reads the same snapshot the
+    # backup API never has to restart when other connections write.
+    source = connect_db()
+    source.execute("BEGIN")
+    source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    return source
+
+backup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup')
+backup_progress = {}  # file name -> page counts of backups still running
+backup_progress_lock = threading.Lock()
+
+def backup_database(source=None, backup_path=None):
+    # Copies BACKUP_PAGES_PER_STEP pages per step into a hidden .partial file,
+    # gzips it if the target ends in .gz, then renames it into place, so the
+    # backups directory only ever holds complete files
+    source = source or open_backup_snapshot()
+    backup_path = backup_path or new_backup_path()
+    name = os.path.basename(backup_path)
+    compress = backup_path.endswith('.gz')
+    raw_path = os.path.join(os.path.dirname(backup_path), f'.{name}.partial')
+    with backup_progress_lock:
+        backup_progress[name] = {'copied_pages': 0, 'total_pages': None, 'started': time.time()}
+
+    def report(status, remaining, total):
+        with backup_progress_lock:
+            backup_progress[name].update(copied_pages=total - remaining, total_pages=total)
+
+    try:
+        dest = sqlite3.connect(raw_path)
+        try:
+            source.backup(dest, pages=BACKUP_PAGES_PER_STEP, progress=report)
+        finally:
+            dest.close()
+        source.rollback()
+        if compress:
+            packed_path = raw_path + '.gz'
+            with open(raw_path, 'rb') as raw, gzip.open(packed_path, 'wb', compresslevel=6) as packed:
+                shutil.copyfileobj(raw, packed, 1024 * 1024)
+            os.remove(raw_path)
+            raw_path = packed_path
+        os.replace(raw_path, backup_path)
+    except Exception:
+        for leftover in (raw_path, raw_path + '.gz'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    finally:
+        source.close()
+        with backup_progress_lock:
+            backup_progress.pop(name, None)
+    rotate_backups()
+    return backup_path
+
+def run_backup_in_background(source, backup_path):
+    try:
+        backup_database(source, backup_path)
+        print(f"Backup written to {backup_path}")
+    except Exception as e:
+        print(f"Backup error: {e}")
+
+def list_backups():
+    # Newest first
+    backup_dir = get_backup_dir()
+    backups = []
+    for entry in os.scandir(backup_dir):
+        if entry.is_file() and BACKUP_FILE_PATTERN.match(entry.name):
+            stat = entry.stat()
+            backups.append({'name': entry.name, 'size': stat.st_size, 'modified': stat.st_mtime})
+    backups.sort(key=lambda backup: (backup['modified'], backup['name']), reverse=True)
+    return backups
+
+def rotate_backups():
+    if BACKUP_KEEP <= 0:
+        return
+    for backup in list_backups()[BACKUP_KEEP:]:
+        os.remove(os.path.join(get_backup_dir(), backup['name']))
+        print(f"Removed old backup {backup['name']}")
+
+def validate_backup(path):
+    # Returns an error message, or None if the file is a healthy routes database
+    with open(path, 'rb') as f:
+        if f.read(16) != b'SQLite format 3\x00':
+            return 'Not a SQLite database'
+    source = sqlite3.connect(path)
+    try:
+        result = [line for row in source.execute("PRAGMA quick_check(5)") for line in row[0].splitlines()]
+        if result != ['ok']:
+            return f"Integrity check failed: {'; '.join(result[:5])}"
+        columns = {row[1] for row in source.execute("PRAGMA table_info(routes)")}
+        if not columns:
+            return 'Not a routes database (no routes table)'
+        missing = {'id', 'start_address', 'end_address', 'distance', 'date'} - columns
+        if missing:
+            return f"Not a routes database (missing {', '.join(sorted(missing))})"
+    except sqlite3.DatabaseError as e:
+        return f"Unreadable database: {e}"
+    finally:
+        source.close()
+    return None
+
+def restore_database(backup_file):
+    # Returns an error message, or None once restored. The upload is checked
+    # first, then copied in with the backup API, which writes the live
+    # database in a single transaction: other connections see either the old
+    # or the restored routes, never a mix.
+    unpacked_path = None
+    try:
+        with open(backup_file, 'rb') as f:
+            if f.read(2) == b'\x1f\x8b':
+                unpacked_path = backup_file + '.unpacked'
+        if unpacked_path:
+            with gzip.open(backup_file, 'rb') as packed, open(unpacked_path, 'wb') as raw:
+                shutil.copyfileobj(packed, raw, 1024 * 1024)
+        source_path = unpacked_path or backup_file
+        error = validate_backup(source_path)
+        if error:
+            return error
+
+        source = sqlite3.connect(source_path)
+        dest = connect_db()
+        try:
+            source.backup(dest, pages=BACKUP_PAGES_PER_STEP)
+            # A restored file keeps the id of the database it came from, so
+            # give it a new one; cached maps and tiles are keyed on it.
+            # Backups from before app_meta existed get one from init_db.
+            dest.execute("DELETE FROM app_meta WHERE key = 'db_id'")
+            dest.commit()
+        except sqlite3.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise
+        finally:
+            source.close()
+            dest.close()
+    except (OSError, EOFError, sqlite3.Error) as e:
+        print(f"Restore error: {e}")
+        return 'Restore failed'
+    finally:
+        if unpacked_path and os.path.exists(unpacked_path):
+            os.remove(unpacked_path)
+
+    # Bring older backups up to the current schema, then drop in-memory state
+    # that described the previous data
+    init_db()
+    geocode_memory_cache.clear()
+    with statistics_breakdown_lock:
+        statistics_breakdown_cache.update({'version': None, 'data': None})
+    return None
+
+def build_export_query(columns, start_date=None, end_date=None):
+    # Newest first, walking the date keyset index so no sort is needed
+    query = f"SELECT {', '.join(EXPORT_COLUMNS[c][0] for c in columns)} FROM routes"
+    conditions, params = [], []
+    if start_date:
+        conditions.append("COALESCE(date, '') >= ?")
+        params.append(start_date)
+    if end_date:
+        conditions.append("COALESCE(date, '') < date(?, '+1 day')")
+        params.append(end_date)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY COALESCE(date, '') DESC, id DESC"
+    return query, params
+
+def iter_export_rows(query, params):
+    # Streaming responses outlive the request context, so use a dedicated connection
+    conn = connect_db()
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+def export_to_csv(columns, query, params, compress=False):
+    # Yields encoded CSV one chunk of rows at a time, optionally gzipped
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def drain():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    writer.writerow([EXPORT_COLUMNS[c][1] for c in columns])
+    yield drain()
+    for rows in iter_export_rows(query, params):
+        writer.writerows(rows)
+        chunk = drain()
+        if chunk:
+            yield chunk
+    if compressor:
+        yield compressor.flush()
+
+class ExportSink(io.RawIOBase):
+    # Write-only file object that hands buffered bytes back to the response
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def export_to_arrow(columns, query, params, file_format):
+    # Each chunk becomes a pandas frame and then a Parquet row group / Arrow batch
+    schema = pa.schema([(c, pa.int64() if c == 'id' else pa.float64() if c == 'distance' else pa.string())
+                        for c in columns])
+    sink = ExportSink()
+    writer = pq.ParquetWriter(sink, schema) if file_format == 'parquet' else pa.ipc.new_stream(sink, schema)
+    try:
+        for rows in iter_export_rows(query, params):
+            frame = pd.DataFrame([tuple(row) for row in rows], columns=columns)
+            writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+class MetricsRegistry:
+    # Thread-safe counters and latency histograms, rendered for /metrics in
+    # the Prometheus text format
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.BUCKETS)] += 1
+            histogram[-1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Records <name>_seconds, and counts <name>_errors_total on exceptions
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f'{name}_errors_total', **labels)
+            raise
+        finally:
+            self.observe(f'{name}_seconds', time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+    def render(self, extra_counters=(), extra_histograms=()):
+        # extra_* are (name, labels dict, value) / (name, labels dict, per-bucket
+        # counts over BUCKETS-compatible bounds, bounds, sum) collected at scrape time
+        with self._lock:
+            counters = [(name, dict(labels), value) for (name, labels), value in self._counters.items()]
+            histograms = [(name, dict(labels), values[:-1], self.BUCKETS, values[-1])
+                          for (name, labels), values in self._histograms.items()]
+        counters += list(extra_counters)
+        histograms += list(extra_histograms)
+
+        lines = []
+        for kind, series in (('counter', counters), ('histogram', histograms)):
+            by_name = {}
+            for entry in series:
+                by_name.setdefault(entry[0], []).append(entry)
+            for name in sorted(by_name):
+                full = f'{self.prefix}_{name}'
+                if name in self._help:
+                    lines.append(f'# HELP {full} {self._help[name]}')
+                lines.append(f'# TYPE {full} {kind}')
+                for entry in sorted(by_name[name], key=lambda e: sorted(e[1].items())):
+                    labels = sorted(entry[1].items())
+                    if kind == 'counter':
+                        lines.append(f'{full}{self._labels(labels)} {entry[2]}')
+                        continue
+                    _, _, buckets, bounds, total = entry
+                    cumulative = 0
+                    for bound, count in zip(list(bounds) + ['+Inf'], buckets):
+                        cumulative += count
+                        lines.append(f'{full}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+                    lines.append(f'{full}_sum{self._labels(labels)} {round(total, 6)}')
+                    lines.append(f'{full}_count{self._labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry('routemanager')
+metrics.describe('http_request_seconds', 'Time spent in Flask route handlers')
+metrics.describe('http_requests_total', 'Requests by endpoint, method and status')
+metrics.describe('db_query_seconds', 'SQLite statement execution time by statement type')
+metrics.describe('db_commit_seconds', 'SQLite commit time')
+metrics.describe('geocode_seconds', 'Geocoder backend call time')
+metrics.describe('gazetteer_lookup_seconds', 'Local gazetteer lookup time')
+metrics.describe('routing_seconds', 'Routing backend call time')
+metrics.describe('map_render_seconds', 'Map build time by step')
+metrics.describe('import_job_seconds', 'Upload job run time')
+metrics.describe('cache_events_total', 'Geocode and route cache events')
+metrics.describe('api_requests_total', 'External API requests by provider and outcome')
+metrics.describe('api_request_seconds', 'External API latency by provider')
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Times statements run through conn.execute/executemany (up to the first
+    # row; fetching is not included) and commits
+    def execute(self, sql, parameters=(), /):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe('db_query_seconds', time.perf_counter() - started, statement=sql_statement_kind(sql))
+
+    def executemany(self, sql, parameters, /):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            metrics.observe('db_query_seconds', time.perf_counter() - started,
+                            statement=sql_statement_kind(sql) + '_MANY')
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            metrics.observe('db_commit_seconds', time.perf_counter() - started)
+
+def sql_statement_kind(sql):
+    word = sql.lstrip().split(None, 1)
+    return word[0].upper() if word else 'UNKNOWN'
+
+profile_lock = threading.Lock()
+
+@contextmanager
+def profiled(label):
+    # Opt-in cProfile capture; one profile at a time, since the profiler hook
+    # is process-wide on newer Pythons. Slow runs are dumped to PROFILE_DIR.
+    if not PROFILE_REQUESTS or not profile_lock.acquire(blocking=False):
+        yield
+        return
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - started
+        if elapsed >= PROFILE_SLOW_SECONDS:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{re.sub(r'[^A-Za-z0-9_.-]', '_', label)}.prof")
+            profiler.dump_stats(path)
+            print(f"Slow {label} ({elapsed:.2f}s), profile written to {path}")
+    finally:
+        profile_lock.release()
+
+class TokenBucket:
+    # Blocking token bucket; rate <= 0 disables limiting
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        # Hold every caller back, e.g. until the provider's quota resets
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+class ApiClient:
+    # Shared keep-alive session per provider with retries, rate limiting
+    # and a latency histogram
+
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, name, rate_limit):
+        self.name = name
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.bucket = TokenBucket(rate_limit)
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'rate_limited': 0,
+                      'latency_sum': 0.0, 'latency_buckets': [0] * (len(self.LATENCY_BUCKETS) + 1)}
+        self._stats_lock = threading.Lock()
+
+    def record_latency(self, elapsed):
+        with self._stats_lock:
+            self.stats['requests'] += 1
+            self.stats['latency_sum'] += elapsed
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    self.stats['latency_buckets'][i] += 1
+                    break
+            else:
+                self.stats['latency_buckets'][-1] += 1
+
+    def count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def backoff(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), HTTP_BACKOFF_MAX)
+            except ValueError:
+                pass
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+    def check_quota(self, response):
+        # OpenCage and GraphHopper both report remaining quota in these headers;
+        # OpenCage sends the reset as an epoch timestamp, GraphHopper as seconds
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(float(remaining))
+            reset = float(reset)
+        except ValueError:
+            return
+        if remaining <= 0:
+            wait_seconds = reset - time.time() if reset > 1e9 else reset
+            if wait_seconds > 0:
+                print(f"{self.name} quota exhausted, pausing {wait_seconds:.0f}s")
+                self.bucket.pause(wait_seconds)
+
+    def get(self, url, params=None):
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            self.bucket.acquire()
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params,
+                                            timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.record_latency(time.perf_counter() - started)
+                if attempt == HTTP_MAX_RETRIES:
+                    self.count('failures')
+                    raise
+                self.count('retries')
+                print(f"{self.name} request failed ({e}), retrying")
+                time.sleep(self.backoff(attempt))
+                continue
+
+            self.record_latency(time.perf_counter() - started)
+            self.check_quota(response)
+            if response.status_code not in self.RETRY_STATUSES:
+                return response
+            if response.status_code == 429:
+                self.count('rate_limited')
+            if attempt == HTTP_MAX_RETRIES:
+                self.count('failures')
+                response.raise_for_status()
+            delay = self.backoff(attempt, response)
+            if response.status_code == 429:
+                self.bucket.pause(delay)
+            self.count('retries')
+            time.sleep(delay)
+
+    def snapshot(self):
+        with self._stats_lock:
+            stats = dict(self.stats, latency_buckets=list(self.stats['latency_buckets']))
+        stats['latency_buckets'] = dict(zip([str(b) for b in self.LATENCY_BUCKETS] + ['+Inf'],
+                                            stats['latency_buckets']))
+        stats['latency_avg'] = round(stats['latency_sum'] / stats['requests'], 4) if stats['requests'] else 0
+        return stats
+
+opencage_client = ApiClient('OpenCage', OPENCAGE_RATE_LIMIT)
+graphhopper_client = ApiClient('GraphHopper', GRAPHHOPPER_RATE_LIMIT)
+
+class LRUCache:
+    # Thread-safe in-memory LRU with per-entry expiry, shared by the upload workers
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # Returns (found, value)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+geocode_memory_cache = LRUCache(GEOCODE_CACHE_SIZE)
+geocode_cache_stats = {'gazetteer_hits': 0, 'memory_hits': 0, 'db_hits': 0, 'negative_hits': 0, 'misses': 0, 'errors': 0}
+cache_stats_lock = threading.Lock()
+
+def count_cache_event(stats, name):
+    with cache_stats_lock:
+        stats[name] += 1
+
+def normalize_address(address):
+    address = re.sub(r'\s*,\s*', ', ', address.strip().lower())
+    return re.sub(r'\s+', ' ', address).strip(', ')
+
+class OpenCageGeocoder:
+    # Geocodes through the OpenCage API; has no offline lookup
+
+    name = 'opencage'
+
+    def lookup(self, address):
+        return None
+
+    def geocode(self, address):
+        # Raises on transport/API errors so failures are not negative-cached
+        response = opencage_client.get(OPENCAGE_URL, params={'q': address, 'key': OPENCAGE_API_KEY})
+        # Bad key, quota and request errors (400/401/402/403) come back with
+        # empty results too; only a 200 means the address wasn't found
+        response.raise_for_status()
+        data = response.json()
+        if data['results']:
+            location = data['results'][0]['geometry']
+            return [location['lat'], location['lng']]
+        return None
+
+def gazetteer_key(address):
+    # Accent-free lowercase tokens with common street words abbreviated,
+    # so "12 Main Street, Springfield" and "12 main st springfield" agree
+    text = unicodedata.normalize('NFKD', address).encode('ascii', 'ignore').decode('ascii').lower()
+    return ' '.join(GAZETTEER_ABBREVIATIONS.get(token, token) for token in re.findall(r'[a-z0-9]+', text))
+
+def address_trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def address_numbers(key):
+    return {token for token in key.split() if any(ch.isdigit() for ch in token)}
+
+class Gazetteer:
+    # In-memory address index: an exact map of normalized keys, plus inverted
+    # indexes (postings as int32 arrays) over numeric tokens and character
+    # trigrams for fuzzy matches. Exact hits are a dict lookup; fuzzy ones
+    # score a small candidate set that shares the query's house number and
+    # postcode, or else its rarest trigrams.
+
+    def __init__(self, keys, coords):
+        self.keys = keys
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.exact = {}
+        postings = {}
+        numbers = {}
+        for i, key in enumerate(keys):
+            self.exact.setdefault(key, i)
+            for gram in address_trigrams(key):
+                postings.setdefault(gram, []).append(i)
+            for number in address_numbers(key):
+                numbers.setdefault(number, []).append(i)
+        self.postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+        self.number_postings = {number: np.array(ids, dtype=np.int32) for number, ids in numbers.items()}
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def load(cls, path):
+        # CSV with address,lat,lng (or lon) columns, or OpenAddresses-style
+        # NUMBER/STREET/UNIT/CITY/REGION/POSTCODE parts with LAT/LON
+        keys, coords = [], []
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            fields = {name.lower(): name for name in reader.fieldnames or []}
+            lat_field = fields.get('lat')
+            lng_field = fields.get('lng') or fields.get('lon')
+            parts = [fields[name] for name in ('number', 'street', 'unit', 'city', 'region', 'postcode')
+                     if name in fields]
+            if not lat_field or not lng_field or not ('address' in fields or parts):
+                raise ValueError(f'{path}: expected address (or street parts) and lat/lng columns')
+            for record in reader:
+                if 'address' in fields:
+                    address = record[fields['address']]
+                else:
+                    address = ' '.join(record[name] for name in parts if record[name])
+                key = gazetteer_key(address or '')
+                try:
+                    lat, lng = float(record[lat_field]), float(record[lng_field])
+                except (TypeError, ValueError):
+                    continue
+                if key:
+                    keys.append(key)
+                    coords.append((lat, lng))
+        return cls(keys, coords)
+
+    def match(self, address):
+        # [lat, lng] of the best entry, or None below GAZETTEER_MIN_SCORE
+        key = gazetteer_key(address)
+        if not key:
+            return None
+        i = self.exact.get(key)
+        if i is None:
+            i = self._fuzzy_match(key)
+            if i is None:
+                return None
+        return self.coords[i].tolist()
+
+    def _fuzzy_match(self, key):
+        grams = address_trigrams(key)
+        numbers = address_numbers(key)
+        if numbers:
+            # Every number in the query must appear in the match
+            if any(number not in self.number_postings for number in numbers):
+                return None
+            postings = sorted((self.number_postings[number] for number in numbers), key=len)
+            candidates = postings[0]
+            for ids in postings[1:]:
+                candidates = np.intersect1d(candidates, ids, assume_unique=True)
+        else:
+            # Dice = 2 * shared / (len + candidate len) and the candidate has
+            # at least shared trigrams, so a match shares at least needed
+            # trigrams and appears in the postings of at least one of the
+            # (len - needed + 1) rarest ones
+            needed = math.ceil(GAZETTEER_MIN_SCORE * len(grams) / (2 - GAZETTEER_MIN_SCORE))
+            postings = sorted((self.postings[gram] for gram in grams if gram in self.postings), key=len)
+            if len(postings) < needed:
+                return None
+            candidates = np.unique(np.concatenate(postings[:len(grams) - needed + 1]))
+        candidates = candidates[:GAZETTEER_MAX_CANDIDATES]
+        best, best_score = None, (GAZETTEER_MIN_SCORE, 0.0)
+        for i in candidates.tolist():
+            candidate = self.keys[i]
+            # House numbers and postcodes in the query must all be present
+            if numbers and not numbers <= address_numbers(candidate):
+                continue
+            candidate_grams = address_trigrams(candidate)
+            shared = len(grams & candidate_grams)
+            coverage = shared / len(grams)
+            dice = 2 * shared / (len(grams) + len(candidate_grams))
+            # Matching house numbers already pin the entry down, so a partial
+            # address ("12 Main St, Springfield") may leave out city or
+            # postcode. Without numbers, Dice penalizes the extra trigrams so
+            # a short query ("Station") isn't matched by any entry containing it.
+            score = (coverage, dice) if numbers else (dice, coverage)
+            if score >= best_score:
+                best, best_score = i, score
+        return best
+
+class LocalGeocoder:
+    # Gazetteer lookups in-process; the remote geocoder (if any) only sees misses
+
+    name = 'local'
+
+    def __init__(self, gazetteer, fallback=None):
+        self.gazetteer = gazetteer
+        self.fallback = fallback
+
+    def lookup(self, address):
+        return self.gazetteer.match(address)
+
+    def geocode(self, address):
+        return self.fallback.geocode(address) if self.fallback else None
+
+geocoder = None
+geocoder_lock = threading.Lock()
+
+def get_geocoder():
+    # Built on first use so the gazetteer only loads when local geocoding is on
+    global geocoder
+    if geocoder is None:
+        with geocoder_lock:
+            if geocoder is None:
+                if GEOCODER_BACKEND == 'local':
+                    if not GAZETTEER_FILE:
+                        raise ValueError('GEOCODER_BACKEND=local requires GAZETTEER_FILE')
+                    started = time.perf_counter()
+                    gazetteer = Gazetteer.load(GAZETTEER_FILE)
+                    print(f"Loaded gazetteer {GAZETTEER_FILE}: {len(gazetteer)} addresses "
+                          f"in {time.perf_counter() - started:.1f}s")
+                    geocoder = LocalGeocoder(gazetteer, OpenCageGeocoder() if GAZETTEER_FALLBACK else None)
+                elif GEOCODER_BACKEND == 'opencage':
+                    geocoder = OpenCageGeocoder()
+                else:
+                    raise ValueError(f'Unknown GEOCODER_BACKEND: {GEOCODER_BACKEND}')
+    return geocoder
+
+def request_geocode(address):
+    backend = get_geocoder()
+    with metrics.timer('geocode', backend=backend.name):
+        return backend.geocode(address)
+
+def lookup_cached_geocode(key):
+    # Cache-only lookup of a normalized address; never calls the API.
+    # Returns (source, coords) where source is 'memory', 'db' or None on a miss.
+    found, coords = geocode_memory_cache.get(key)
+    if found:
+        return 'memory', coords
+    try:
+        conn = get_db()
+        row = conn.execute("SELECT lat, lng, expires_at FROM geocode_cache WHERE address_key = ? AND expires_at > ?",
+                           (key, time.time())).fetchone()
+    except sqlite3.Error as e:
+        print(f"Geocode cache read error: {e}")
+        return None, None
+    if row is None:
+        return None, None
+    coords = [row['lat'], row['lng']] if row['lat'] is not None else None
+    geocode_memory_cache.set(key, coords, row['expires_at'])
+    return 'db', coords
+
+def geocode_address(address):
+    if not address:
+        return None
+    key = normalize_address(address)
+
+    # Offline gazetteer hits skip the caches entirely
+    backend = get_geocoder()
+    if backend.name == 'local':
+        with metrics.timer('gazetteer_lookup'):
+            coords = backend.lookup(address)
+    else:
+        coords = None
+    if coords:
+        count_cache_event(geocode_cache_stats, 'gazetteer_hits')
+        return coords
+
+    source, coords = lookup_cached_geocode(key)
+    if source:
+        count_cache_event(geocode_cache_stats, f'{source}_hits' if coords else 'negative_hits')
+        return coords
+
+    count_cache_event(geocode_cache_stats, 'misses')
+    try:
+        coords = request_geocode(address)
+    except Exception as e:
+        count_cache_event(geocode_cache_stats, 'errors')
+        print(f"Geocoding error: {e}")
+        return None
+
+    expires_at = time.time() + (GEOCODE_CACHE_TTL if coords else GEOCODE_NEGATIVE_TTL)
+    geocode_memory_cache.set(key, coords, expires_at)
+    try:
+        conn = get_db()
+        conn.execute("INSERT OR REPLACE INTO geocode_cache (address_key, lat, lng, expires_at) VALUES (?, ?, ?, ?)",
+                     (key, coords[0] if coords else None, coords[1] if coords else None, expires_at))
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Geocode cache write error: {e}")
+    return coords
+
+route_cache_stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'errors': 0}
+
+def route_cache_key(start_coords, end_coords):
+    p = ROUTE_CACHE_PRECISION
+    key = (f"{start_coords[0]:.{p}f},{start_coords[1]:.{p}f};"
+           f"{end_coords[0]:.{p}f},{end_coords[1]:.{p}f}")
+    # Other backends get their own namespace; GraphHopper keeps the original keys
+    return key if ROUTING_BACKEND == 'graphhopper' else f"{ROUTING_BACKEND}:{key}"
+
+class GraphHopperBackend:
+    # Routes through the GraphHopper API
+
+    name = 'graphhopper'
+
+    def route(self, start_coords, end_coords):
+        # Raises on transport/API errors; returns None when no path exists
+        response = graphhopper_client.get(GRAPHHOPPER_URL, params={
+            'point': [f"{start_coords[0]},{start_coords[1]}", f"{end_coords[0]},{end_coords[1]}"],
+            'vehicle': 'car',
+            'points_encoded': 'false',
+            'key': GRAPHHOPPER_API_KEY
+        })
+        data = response.json()
+        if 'paths' in data and data['paths']:
+            path = data['paths'][0]
+            return {
+                'distance': path['distance'] / 1000,  # Convert to kilometers
+                'points': path['points']['coordinates']  # List of [lon, lat] coordinates
+            }
+        return None
+
+    def matrix(self, start_coords, destinations):
+        # One call for many destinations; distances only (km, None if unreachable)
+        response = graphhopper_client.get(GRAPHHOPPER_MATRIX_URL, params={
+            'from_point': f"{start_coords[0]},{start_coords[1]}",
+            'to_point': [f"{lat},{lng}" for lat, lng in destinations],
+            'out_array': 'distances',
+            'vehicle': 'car',
+            'key': GRAPHHOPPER_API_KEY
+        })
+        data = response.json()
+        if not data.get('distances'):
+            raise ValueError(data.get('message', 'No distances in matrix response'))
+        return [None if distance is None else distance / 1000 for distance in data['distances'][0]]
+
+class RoadGraph:
+    # Directed road network in CSR form: the edges leaving node i are
+    # indices[indptr[i]:indptr[i + 1]], with lengths in metres in weights.
+    # Searches run on list copies of the arrays, which index much faster
+    # than NumPy scalars inside Python loops.
+
+    def __init__(self, lat, lon, indptr, indices, weights):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self._adjacency = (self.indptr.tolist(), self.indices.tolist(), self.weights.tolist())
+        self._lat_list, self._lon_list = self.lat.tolist(), self.lon.tolist()
+
+        # Nearest-node grid: node ids sorted by cell
+        cells = self._cells(self.lat, self.lon)
+        self._cell_order = np.argsort(cells, kind='stable')
+        self._cell_keys = cells[self._cell_order]
+
+    def __len__(self):
+        return len(self.lat)
+
+    @staticmethod
+    def _cells(lat, lon):
+        rows = np.floor((np.asarray(lat) + 90) / ROAD_GRAPH_CELL).astype(np.int64)
+        cols = np.floor((np.asarray(lon) + 180) / ROAD_GRAPH_CELL).astype(np.int64)
+        return rows * 100000 + cols
+
+    @classmethod
+    def from_edges(cls, lat, lon, sources, targets, weights):
+        # Builds the CSR arrays from parallel edge arrays (node ids index lat/lon)
+        sources = np.asarray(sources, dtype=np.int64)
+        order = np.argsort(sources, kind='stable')
+        indptr = np.zeros(len(lat) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(lat)), out=indptr[1:])
+        return cls(lat, lon, indptr, np.asarray(targets)[order], np.asarray(weights)[order])
+
+    def reversed(self):
+        sources = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+        return RoadGraph.from_edges(self.lat, self.lon, self.indices, sources, self.weights)
+
+    def nearest_node(self, lat, lon):
+        # (node, distance_km) of the closest node, searching rings of grid cells
+        row, col = divmod(int(self._cells(lat, lon)), 100000)
+        best = (None, float('inf'))
+        for radius in range(0, 64):
+            ring = [(r, c) for r in range(row - radius, row + radius + 1)
+                    for c in range(col - radius, col + radius + 1)
+                    if max(abs(r - row), abs(c - col)) == radius]
+            candidates = []
+            for r, c in ring:
+                key = r * 100000 + c
+                lo, hi = np.searchsorted(self._cell_keys, [key, key + 1])
+                if hi > lo:
+                    candidates.append(self._cell_order[lo:hi])
+            if candidates:
+                nodes = np.concatenate(candidates)
+                distances = haversine_km(lat, lon, self.lat[nodes], self.lon[nodes])
+                i = int(np.argmin(distances))
+                if distances[i] < best[1]:
+                    best = (int(nodes[i]), float(distances[i]))
+            # Anything beyond this ring is at least radius cells away
+            if best[0] is not None and best[1] <= radius * ROAD_GRAPH_CELL * 111.0 * math.cos(math.radians(min(abs(lat), 89))):
+                break
+        return best
+
+    def shortest_path(self, source, target):
+        # A* with a great-circle heuristic (admissible: weights are lengths).
+        # Returns (metres, [node, ...]) or None when target is unreachable.
+        indptr, indices, weights = self._adjacency
+        lat, lon = self._lat_list, self._lon_list
+        target_lat, target_lon = math.radians(lat[target]), math.radians(lon[target])
+        cos_target = math.cos(target_lat)
+
+        def heuristic(node):
+            node_lat, node_lon = math.radians(lat[node]), math.radians(lon[node])
+            a = math.sin((target_lat - node_lat) / 2) ** 2 + \
+                math.cos(node_lat) * cos_target * math.sin((target_lon - node_lon) / 2) ** 2
+            return 6371000.0 * 2 * math.asin(min(1.0, math.sqrt(a))) * 0.999
+
+        distance = {source: 0.0}
+        parent = {source: -1}
+        heap = [(heuristic(source), 0.0, source)]
+        settled = set()
+        while heap:
+            _, node_distance, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            if node == target:
+                return node_distance, unwind_path(parent, target)
+            settled.add(node)
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[i]
+                candidate = node_distance + weights[i]
+                if candidate < distance.get(neighbor, float('inf')):
+                    distance[neighbor] = candidate
+                    parent[neighbor] = node
+                    heapq.heappush(heap, (candidate + heuristic(neighbor), candidate, neighbor))
+        return None
+
+    def distances_from(self, source, targets):
+        # One-to-many Dijkstra that stops once every target is settled
+        indptr, indices, weights = self._adjacency
+        remaining = set(targets)
+        found = {}
+        distance = {source: 0.0}
+        heap = [(0.0, source)]
+        while heap and remaining:
+            node_distance, node = heapq.heappop(heap)
+            if node_distance > distance[node]:
+                continue
+            if node in remaining:
+                remaining.discard(node)
+                found[node] = node_distance
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[i]
+                candidate = node_distance + weights[i]
+                if candidate < distance.get(neighbor, float('inf')):
+                    distance[neighbor] = candidate
+                    heapq.heappush(heap, (candidate, neighbor))
+        return found
+
+    def path_points(self, nodes):
+        return [[self._lon_list[node], self._lat_list[node]] for node in nodes]
+
+    def save(self, path, **extra):
+        np.savez(path, lat=self.lat, lon=self.lon, indptr=self.indptr, indices=self.indices,
+                 weights=self.weights, **extra)
+
+def unwind_path(parent, node):
+    path = []
+    while node != -1:
+        path.append(node)
+        node = parent[node]
+    path.reverse()
+    return path
+
+def read_edge_list(path):
+    # CSV with from_lat,from_lon,to_lat,to_lon and optional length_m and
+    # oneway columns. Nodes are identified by their rounded coordinates.
+    node_ids = {}
+    lat, lon, sources, targets, weights = [], [], [], [], []
+
+    def node(node_lat, node_lon):
+        key = (round(node_lat, 7), round(node_lon, 7))
+        if key not in node_ids:
+            node_ids[key] = len(lat)
+            lat.append(key[0])
+            lon.append(key[1])
+        return node_ids[key]
+
+    with open(path, newline='', encoding='utf-8') as f:
+        for record in csv.DictReader(f):
+            u = node(float(record['from_lat']), float(record['from_lon']))
+            v = node(float(record['to_lat']), float(record['to_lon']))
+            length = record.get('length_m')
+            length = float(length) if length else \
+                float(haversine_km(lat[u], lon[u], lat[v], lon[v])) * 1000
+            sources.append(u)
+            targets.append(v)
+            weights.append(length)
+            if str(record.get('oneway') or '').lower() not in ('1', 'yes', 'true'):
+                sources.append(v)
+                targets.append(u)
+                weights.append(length)
+    return lat, lon, sources, targets, weights
+
+def read_osm_xml(path):
+    # Car-accessible ways from an .osm XML extract, honouring oneway tags
+    import xml.etree.ElementTree as ElementTree
+    coords = {}
+    ways = []
+    for _, element in ElementTree.iterparse(path):
+        if element.tag == 'node':
+            coords[element.get('id')] = (float(element.get('lat')), float(element.get('lon')))
+        elif element.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+            if tags.get('highway') in OSM_CAR_HIGHWAYS:
+                oneway = tags.get('oneway', '')
+                if oneway in ('yes', 'true', '1') or tags.get('highway') == 'motorway' or \
+                        tags.get('junction') == 'roundabout':
+                    direction = 1
+                elif oneway == '-1':
+                    direction = -1
+                else:
+                    direction = 0
+                ways.append(([nd.get('ref') for nd in element.iter('nd')], direction))
+            element.clear()
+        elif element.tag == 'relation':
+            element.clear()
+
+    node_ids = {}
+    lat, lon, sources, targets, weights = [], [], [], [], []
+    for refs, direction in ways:
+        refs = [ref for ref in refs if ref in coords]
+        for a, b in zip(refs, refs[1:]):
+            ends = []
+            for ref in (a, b):
+                if ref not in node_ids:
+                    node_ids[ref] = len(lat)
+                    lat.append(coords[ref][0])
+                    lon.append(coords[ref][1])
+                ends.append(node_ids[ref])
+            u, v = ends
+            length = float(haversine_km(lat[u], lon[u], lat[v], lon[v])) * 1000
+            if direction >= 0:
+                sources.append(u)
+                targets.append(v)
+                weights.append(length)
+            if direction <= 0:
+                sources.append(v)
+                targets.append(u)
+                weights.append(length)
+    return lat, lon, sources, targets, weights
+
+class ContractionHierarchy:
+    # Contraction hierarchy over a RoadGraph. Nodes are contracted in order
+    # of edge difference (plus deleted neighbours and level), adding shortcuts
+    # where no witness path exists; queries then run a bidirectional Dijkstra
+    # that only climbs in rank and settles far fewer nodes than A*.
+
+    WITNESS_SETTLE_LIMIT = 60
+
+    def __init__(self, up, down, shortcuts):
+        # up: upward edges by source; down: upward edges reversed, by target;
+        # shortcuts: (source, target) -> middle node for path unpacking
+        self.up = up
+        self.down = down
+        self.shortcuts = shortcuts
+        self._up = (up.indptr.tolist(), up.indices.tolist(), up.weights.tolist())
+        self._down = (down.indptr.tolist(), down.indices.tolist(), down.weights.tolist())
+
+    @classmethod
+    def build(cls, graph):
+        n = len(graph)
+        outgoing = [dict() for _ in range(n)]
+        incoming = [dict() for _ in range(n)]
+        for u in range(n):
+            for i in range(graph.indptr[u], graph.indptr[u + 1]):
+                v, w = int(graph.indices[i]), float(graph.weights[i])
+                if v != u and w < outgoing[u].get(v, float('inf')):
+                    outgoing[u][v] = w
+                    incoming[v][u] = w
+        edges = {(u, v): (w, -1) for u in range(n) for v, w in outgoing[u].items()}
+        contracted = [False] * n
+        deleted_neighbors = [0] * n
+        level = [0] * n
+        rank = [0] * n
+
+        def witness_distances(source, excluded, limit):
+            distance = {source: 0.0}
+            heap = [(0.0, source)]
+            settled = 0
+            while heap and settled < cls.WITNESS_SETTLE_LIMIT:
+                d, node = heapq.heappop(heap)
+                if d > limit:
+                    break
+                if d > distance[node]:
+                    continue
+                settled += 1
+                for neighbor, w in outgoing[node].items():
+                    if neighbor == excluded:
+                        continue
+                    candidate = d + w
+                    if candidate < distance.get(neighbor, float('inf')):
+                        distance[neighbor] = candidate
+                        heapq.heappush(heap, (candidate, neighbor))
+            return distance
+
+        def needed_shortcuts(node):
+            shortcuts = []
+            for u, w_in in incoming[node].items():
+                targets = [(v, w_in + w_out) for v, w_out in outgoing[node].items() if v != u]
+                if not targets:
+                    continue
+                witnesses = witness_distances(u, node, max(d for _, d in targets))
+                shortcuts.extend((u, v, d) for v, d in targets if witnesses.get(v, float('inf')) > d)
+            return shortcuts
+
+        def priority(node):
+            return (2 * (len(needed_shortcuts(node)) - len(incoming[node]) - len(outgoing[node]))
+                    + deleted_neighbors[node] + level[node])
+
+        heap = [(priority(node), node) for node in range(n)]
+        heapq.heapify(heap)
+        order = 0
+        while heap:
+            _, node = heapq.heappop(heap)
+            if contracted[node]:
+                continue
+            # Lazy update: re-queue if the priority went stale
+            current = priority(node)
+            if heap and current > heap[0][0]:
+                heapq.heappush(heap, (current, node))
+                continue
+            for u, v, d in needed_shortcuts(node):
+                if d < outgoing[u].get(v, float('inf')):
+                    outgoing[u][v] = d
+                    incoming[v][u] = d
+                    edges[(u, v)] = (d, node)
+            for u in incoming[node]:
+                del outgoing[u][node]
+                deleted_neighbors[u] += 1
+                level[u] = max(level[u], level[node] + 1)
+            for v in outgoing[node]:
+                del incoming[v][node]
+                deleted_neighbors[v] += 1
+                level[v] = max(level[v], level[node] + 1)
+            contracted[node] = True
+            rank[node] = order
+            order += 1
+
+        up_edges = [(u, v, w) for (u, v), (w, _) in edges.items() if rank[v] > rank[u]]
+        down_edges = [(v, u, w) for (u, v), (w, _) in edges.items() if rank[u] > rank[v]]
+        shortcuts = {(u, v): mid for (u, v), (_, mid) in edges.items() if mid >= 0}
+        return cls(cls._csr(graph, up_edges), cls._csr(graph, down_edges), shortcuts)
+
+    @staticmethod
+    def _csr(graph, edges):
+        if not edges:
+            return RoadGraph.from_edges(graph.lat, graph.lon, [], [], [])
+        sources, targets, weights = zip(*edges)
+        return RoadGraph.from_edges(graph.lat, graph.lon, sources, targets, weights)
+
+    def shortest_path(self, source, target):
+        # Bidirectional upward search; returns (metres, [node, ...]) or None
+        searches = ((self._up, {source: 0.0}, {source: -1}, [(0.0, source)]),
+                    (self._down, {target: 0.0}, {target: -1}, [(0.0, target)]))
+        best, meeting = float('inf'), None
+        while any(heap and heap[0][0] < best for _, _, _, heap in searches):
+            for side, ((indptr, indices, weights), distance, parent, heap) in enumerate(searches):
+                if not heap or heap[0][0] >= best:
+                    continue
+                d, node = heapq.heappop(heap)
+                if d > distance[node]:
+                    continue
+                other = searches[1 - side][1]
+                if node in other and d + other[node] < best:
+                    best, meeting = d + other[node], node
+                for i in range(indptr[node], indptr[node + 1]):
+                    neighbor = indices[i]
+                    candidate = d + weights[i]
+                    if candidate < distance.get(neighbor, float('inf')):
+                        distance[neighbor] = candidate
+                        parent[neighbor] = node
+                        heapq.heappush(heap, (candidate, neighbor))
+        if meeting is None:
+            return None
+        forward = unwind_path(searches[0][2], meeting)
+        backward = unwind_path(searches[1][2], meeting)[::-1]
+        return best, self.unpack(forward + backward[1:])
+
+    def unpack(self, nodes):
+        # Expand shortcut edges into the original road nodes
+        path = [nodes[0]]
+        for u, v in zip(nodes, nodes[1:]):
+            stack = [(u, v)]
+            while stack:
+                a, b = stack.pop()
+                mid = self.shortcuts.get((a, b))
+                if mid is None:
+                    path.append(b)
+                else:
+                    stack.append((mid, b))
+                    stack.append((a, mid))
+        return path
+
+    def save_arrays(self):
+        keys = np.array(list(self.shortcuts), dtype=np.int64).reshape(-1, 2)
+        return {'up_indptr': self.up.indptr, 'up_indices': self.up.indices, 'up_weights': self.up.weights,
+                'down_indptr': self.down.indptr, 'down_indices': self.down.indices,
+                'down_weights': self.down.weights, 'shortcut_keys': keys,
+                'shortcut_mids': np.array(list(self.shortcuts.values()), dtype=np.int64)}
+
+    @classmethod
+    def from_arrays(cls, graph, data):
+        up = RoadGraph(graph.lat, graph.lon, data['up_indptr'], data['up_indices'], data['up_weights'])
+        down = RoadGraph(graph.lat, graph.lon, data['down_indptr'], data['down_indices'], data['down_weights'])
+        shortcuts = dict(zip(map(tuple, data['shortcut_keys'].tolist()), data['shortcut_mids'].tolist()))
+        return cls(up, down, shortcuts)
+
+def load_road_graph(path, contract=False):
+    # Parses the source file once and caches the compiled arrays next to it
+    # (<file>.npz), rebuilding when the source is newer
+    compiled = path + '.npz'
+    if os.path.exists(compiled) and os.path.getmtime(compiled) >= os.path.getmtime(path):
+        data = np.load(compiled)
+        graph = RoadGraph(data['lat'], data['lon'], data['indptr'], data['indices'], data['weights'])
+        if not contract:
+            return graph, None
+        if 'up_indptr' in data:
+            return graph, ContractionHierarchy.from_arrays(graph, data)
+    else:
+        started = time.perf_counter()
+        reader = read_osm_xml if path.endswith('.osm') else read_edge_list
+        graph = RoadGraph.from_edges(*reader(path))
+        print(f"Loaded road graph {path}: {len(graph)} nodes, {len(graph.indices)} edges "
+              f"in {time.perf_counter() - started:.1f}s")
+
+    hierarchy = None
+    extra = {}
+    if contract:
+        started = time.perf_counter()
+        hierarchy = ContractionHierarchy.build(graph)
+        extra = hierarchy.save_arrays()
+        print(f"Contracted road graph in {time.perf_counter() - started:.1f}s "
+              f"({len(hierarchy.shortcuts)} shortcuts)")
+    graph.save(compiled, **extra)
+    return graph, hierarchy
+
+class LocalRoutingBackend:
+    # In-process routing over a RoadGraph; query points snap to the nearest
+    # node within ROAD_GRAPH_SNAP_KM
+
+    name = 'local'
+
+    def __init__(self, graph, hierarchy=None):
+        self.graph = graph
+        self.hierarchy = hierarchy
+
+    def snap(self, coords):
+        node, distance = self.graph.nearest_node(coords[0], coords[1])
+        return node if node is not None and distance <= ROAD_GRAPH_SNAP_KM else None
+
+    def route(self, start_coords, end_coords):
+        source, target = self.snap(start_coords), self.snap(end_coords)
+        if source is None or target is None:
+            return None
+        result = (self.hierarchy or self.graph).shortest_path(source, target)
+        if result is None:
+            return None
+        metres, nodes = result
+        points = self.graph.path_points(nodes)
+        if len(points) == 1:
+            points.append(points[0])
+        return {'distance': metres / 1000, 'points': points}
+
+    def matrix(self, start_coords, destinations):
+        source = self.snap(start_coords)
+        targets = [self.snap(coords) for coords in destinations]
+        if source is None:
+            return [None] * len(destinations)
+        found = self.graph.distances_from(source, [t for t in targets if t is not None])
+        return [None if t is None or t not in found else found[t] / 1000 for t in targets]
+
+routing_backend = None
+routing_backend_lock = threading.Lock()
+
+def get_routing_backend():
+    # Built on first use so the road graph only loads when local routing is on
+    global routing_backend
+    if routing_backend is None:
+        with routing_backend_lock:
+            if routing_backend is None:
+                if ROUTING_BACKEND == 'local':
+                    if not ROAD_GRAPH_FILE:
+                        raise ValueError('ROUTING_BACKEND=local requires ROAD_GRAPH_FILE')
+                    routing_backend = LocalRoutingBackend(*load_road_graph(ROAD_GRAPH_FILE, ROAD_GRAPH_CONTRACT))
+                elif ROUTING_BACKEND == 'graphhopper':
+                    routing_backend = GraphHopperBackend()
+                else:
+                    raise ValueError(f'Unknown ROUTING_BACKEND: {ROUTING_BACKEND}')
+    return routing_backend
+
+def request_route(start_coords, end_coords):
+    backend = get_routing_backend()
+    with metrics.timer('routing', backend=backend.name, call='route'):
+        return backend.route(start_coords, end_coords)
+
+def request_route_matrix(start_coords, destinations):
+    backend = get_routing_backend()
+    with metrics.timer('routing', backend=backend.name, call='matrix'):
+        return backend.matrix(start_coords, destinations)
+
+def store_cached_route(route_key, start_coords, end_coords, route_data, computed_at=None):
+    conn = get_db()
+    conn.execute("""INSERT OR REPLACE INTO route_cache
+                    (route_key, start_lat, start_lng, end_lat, end_lng, distance, route_points, computed_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                 (route_key, start_coords[0], start_coords[1], end_coords[0], end_coords[1],
+                  route_data['distance'], encode_route_points(route_data['points']), computed_at or time.time()))
+    conn.commit()
+
+def calculate_route(start_coords, end_coords, refresh=False):
+    # Returned dicts carry the route_key so callers can link rows to the cache
+    route_key = route_cache_key(start_coords, end_coords)
+    cached = None
+    if not refresh:
+        try:
+            conn = get_db()
+            cached = conn.execute("SELECT distance, route_points, computed_at FROM route_cache WHERE route_key = ?",
+                                  (route_key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Route cache read error: {e}")
+
+    if cached and cached['computed_at'] > time.time() - ROUTE_CACHE_TTL:
+        count_cache_event(route_cache_stats, 'hits')
+        return {'distance': cached['distance'], 'points': decode_route_points(cached['route_points']), 'route_key': route_key}
+
+    count_cache_event(route_cache_stats, 'misses')
+    try:
+        route_data = request_route(start_coords, end_coords)
+    except Exception as e:
+        count_cache_event(route_cache_stats, 'errors')
+        print(f"Route calculation error: {e}")
+        route_data = None
+
+    if route_data is None:
+        if cached:
+            # Serve the stale geometry rather than failing outright
+            count_cache_event(route_cache_stats, 'stale_hits')
+            return {'distance': cached['distance'], 'points': decode_route_points(cached['route_points']), 'route_key': route_key}
+        return None
+
+    try:
+        store_cached_route(route_key, start_coords, end_coords, route_data)
+    except sqlite3.Error as e:
+        print(f"Route cache write error: {e}")
+    route_data['route_key'] = route_key
+    return route_data
+
+def parse_route_date(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+def process_upload_address(start_coords, address):
+    # Geocode and route a single upload destination. Runs on the upload worker
+    # pool, so it must not touch the request context or the upload's connection.
+    try:
+        print(f"Processing address: {address}")
+        coords = geocode_address(address)
+        if not coords:
+            print(f"Failed to geocode address: {address}")
+            return {'address': address, 'success': False, 'error': 'Could not geocode address'}
+
+        route_data = calculate_route(start_coords, coords)
+        if not route_data:
+            print(f"Failed to calculate route for: {address}")
+            return {'address': address, 'success': False, 'error': 'Could not calculate route'}
+
+        print(f"Successfully calculated route for: {address}")
+        route_data['geometry'] = prepare_route_geometry(route_data['points'])
+        return {'address': address, 'success': True, 'route_data': route_data}
+    except Exception as e:
+        print(f"Error processing address {address}: {str(e)}")
+        return {'address': address, 'success': False, 'error': str(e)}
+
+def iter_import_records(stream, file_format):
+    # Yields (line_number, dict) without reading the whole body into memory
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, ValueError(f'Invalid JSON: {e}')
+            continue
+        yield line_number, record if isinstance(record, dict) else ValueError('Row must be a JSON object')
+
+def parse_import_coordinate(record, prefix):
+    # Returns (lat, lng) or None; half-specified pairs are rejected
+    lat, lng = record.get(f'{prefix}_lat'), record.get(f'{prefix}_lng', record.get(f'{prefix}_lon'))
+    if lat in (None, '') and lng in (None, ''):
+        return None
+    try:
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError):
+        raise ValueError(f'{prefix}_lat/{prefix}_lng must both be numbers')
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError(f'{prefix} coordinates out of range')
+    return (lat, lng)
+
+def parse_import_record(record):
+    # Validates one CSV/NDJSON row. Geometry is [[lon, lat], ...] (a JSON string in CSV).
+    start_address = str(record.get('start_address') or '').strip()
+    end_address = str(record.get('end_address') or '').strip()
+    if not start_address or not end_address:
+        raise ValueError('start_address and end_address are required')
+
+    distance = record.get('distance')
+    if distance in (None, ''):
+        distance = None
+    else:
+        try:
+            distance = float(distance)
+        except (TypeError, ValueError):
+            raise ValueError('distance must be a number')
+        if not math.isfinite(distance) or distance < 0:
+            raise ValueError('distance must be a non-negative number')
+
+    date = record.get('date')
+    if date in (None, ''):
+        date = None
+    else:
+        try:
+            date = datetime.fromisoformat(str(date).strip()).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            raise ValueError('date must be an ISO 8601 date')
+
+    points = record.get('route_points')
+    if points in (None, ''):
+        points = None
+    else:
+        try:
+            if isinstance(points, str):
+                points = json.loads(points)
+            points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        except (TypeError, ValueError):
+            raise ValueError('route_points must be a list of [lon, lat] pairs')
+        if len(points) < 2 or not np.isfinite(points).all() or \
+                (np.abs(points[:, 0]) > 180).any() or (np.abs(points[:, 1]) > 90).any():
+            raise ValueError('route_points must hold at least two valid [lon, lat] pairs')
+
+    return {
+        'start_address': start_address,
+        'end_address': end_address,
+        'distance': distance,
+        'date': date,
+        'notes': record.get('notes') or '',
+        'start': parse_import_coordinate(record, 'start'),
+        'end': parse_import_coordinate(record, 'end'),
+        'points': points
+    }
+
+def resolve_import_row(row):
+    # Fills in whatever a row is missing (coordinates, geometry, distance)
+    # through the geocode and route caches. Runs on a worker thread.
+    try:
+        start = row['start'] or geocode_address(row['start_address'])
+        end = row['end'] or geocode_address(row['end_address'])
+        if not start or not end:
+            return row, 'Could not geocode address'
+        row['start'], row['end'] = start, end
+        route_data = calculate_route(start, end)
+        if not route_data:
+            return row, 'Could not calculate route'
+        row['points'] = np.asarray(route_data['points'], dtype=np.float64).reshape(-1, 2)
+        if row['distance'] is None:
+            row['distance'] = route_data['distance']
+        return row, None
+    except Exception as e:
+        return row, str(e)
+
+def import_row_values(row):
+    # Column values for one routes row. Levels of detail are not built here;
+    # the map creates them the first time it needs them.
+    points = row['points']
+    route_key = route_cache_key(row['start'], row['end']) if row['start'] and row['end'] else None
+    if points is not None:
+        route_points = encode_route_points(points)
+        bbox, endpoints = route_bbox(points), route_endpoints(points)
+        if row['distance'] is None:
+            row['distance'] = float(haversine_km(points[:-1, 1], points[:-1, 0], points[1:, 1], points[1:, 0]).sum())
+    elif route_key:
+        geometry = endpoint_geometry(row['start'], row['end'])
+        route_points, bbox, endpoints = None, geometry['bbox'], geometry['endpoints']
+    else:
+        route_points, bbox, endpoints = None, (None,) * 4, (None,) * 4
+    return (row['start_address'], row['end_address'], row['distance'], row['date'], row['notes'],
+            route_points, route_key, *bbox, *endpoints)
+
+def insert_import_batch(conn, rows):
+    # One executemany per batch; rows already in the table are skipped in SQL.
+    # Geometry is matched or stored by content first, and any stored only for
+    # skipped rows is dropped again. Pre-computed routes also seed the route
+    # cache so later lookups hit it.
+    values = [import_row_values(row) for row in rows]
+    geometry_ids = [store_route_geometry(conn, {'route_points': value[5], 'hash': geometry_hash(value[5]), 'lods': []})
+                    if value[5] is not None else None for value in values]
+    cursor = conn.executemany("""INSERT INTO routes
+                                  (start_address, end_address, distance, date, notes, geometry_id, route_key,
+                                   min_lon, min_lat, max_lon, max_lat, start_lon, start_lat, end_lon, end_lat)
+                                  SELECT ?1, ?2, ?3, COALESCE(?4, date('now')), ?5, ?6, ?7, ?8, ?9, ?10, ?11, ?12, ?13, ?14, ?15
+                                  WHERE NOT EXISTS (SELECT 1 FROM routes
+                                                    WHERE start_address = ?1 AND end_address = ?2
+                                                      AND date = COALESCE(?4, date('now')))""",
+                              [(*value[:5], geometry_id, *value[6:]) for value, geometry_id in zip(values, geometry_ids)])
+    inserted = cursor.rowcount
+    conn.executemany("DELETE FROM route_geometry WHERE id = ? AND refcount = 0",
+                     [(geometry_id,) for geometry_id in set(geometry_ids) if geometry_id is not None])
+    conn.executemany("""INSERT OR IGNORE INTO route_cache
+                        (route_key, start_lat, start_lng, end_lat, end_lng, distance, route_points, computed_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                     [(value[6], *row['start'], *row['end'], value[2], value[5], parse_route_date(row['date']))
+                      for row, value in zip(rows, values) if value[5] is not None and value[6]])
+    conn.commit()
+    return inserted
+
+import_job_executor = ThreadPoolExecutor(max_workers=IMPORT_JOB_WORKERS, thread_name_prefix='import-job')
+import_job_subscribers = {}  # job_id -> queues of SSE listeners
+import_job_lock = threading.Lock()
+cancelled_import_jobs = set()
+running_import_jobs = set()  # jobs with a run in progress, so a resume can't start a second one
+
+def publish_import_job_event(job_id, message):
+    with import_job_lock:
+        for listener in import_job_subscribers.get(job_id, ()):
+            listener.put(message)
+
+def import_job_summary(job):
+    summary = {key: job[key] for key in ('id', 'start_address', 'mode', 'status', 'total', 'processed',
+                                          'successful', 'error', 'created_at', 'updated_at')}
+    summary['failed'] = job['processed'] - job['successful']
+    summary['progress'] = (job['processed'] * 100) // job['total'] if job['total'] else 100
+    return summary
+
+def create_import_job(conn, start_address, addresses, mode='route'):
+    # addresses is any iterable of destination lines; items are written in
+    # chunks so the file never has to be held in memory
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn.execute("""INSERT INTO import_jobs (id, start_address, mode, status, total, created_at, updated_at)
+                    VALUES (?, ?, ?, 'queued', 0, ?, ?)""", (job_id, start_address, mode, now, now))
+    total = 0
+    chunk = []
+    for address in addresses:
+        total += 1
+        chunk.append((job_id, total, address))
+        if len(chunk) >= IMPORT_BATCH_SIZE:
+            conn.executemany("INSERT INTO import_job_items (job_id, line, address) VALUES (?, ?, ?)", chunk)
+            chunk.clear()
+    conn.executemany("INSERT INTO import_job_items (job_id, line, address) VALUES (?, ?, ?)", chunk)
+    conn.execute("UPDATE import_jobs SET total = ? WHERE id = ?", (total, job_id))
+    conn.commit()
+    return job_id, total
+
+def claim_import_items(conn, job_id):
+    # Moves pending items to 'running' a page at a time. The select and update
+    # share one write transaction, so no line is ever handed out twice.
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute("""SELECT line, address FROM import_job_items
+                               WHERE job_id = ? AND status = 'pending'
+                               ORDER BY line LIMIT 1000""", (job_id,)).fetchall()
+        conn.executemany("UPDATE import_job_items SET status = 'running' WHERE job_id = ? AND line = ?",
+                         [(job_id, row['line']) for row in rows])
+        conn.commit()
+        if not rows:
+            return
+        for row in rows:
+            yield row['line'], row['address']
+
+def finish_import_job(conn, job_id, status, error=None):
+    conn.execute("UPDATE import_jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                 (status, error, time.time(), job_id))
+    conn.commit()
+
+def run_import_job(job_id):
+    with metrics.timer('import_job'), profiled(f'import_job {job_id}'):
+        process_import_job(job_id)
+
+def process_import_job(job_id):
+    # Runs on import_job_executor with its own connection. Destinations fan
+    # out over a per-job pool; results are committed in batches together with
+    # their item checkpoints, then reported to listeners.
+    with import_job_lock:
+        if job_id in running_import_jobs:
+            print(f"Import job {job_id} is already running")
+            return
+        running_import_jobs.add(job_id)
+    conn = connect_db()
+    try:
+        cursor = conn.execute("""UPDATE import_jobs SET status = 'running', error = NULL, updated_at = ?
+                                 WHERE id = ? AND status IN ('queued', 'running')""", (time.time(), job_id))
+        conn.commit()
+        if not cursor.rowcount:
+            # Cancelled while queued (cancel_import_job normally reports that,
+            # unless this run had already registered), finished or deleted
+            if job_id in cancelled_import_jobs:
+                publish_import_job_event(job_id, {'type': 'cancelled'})
+            return
+        # Items a previous run claimed but never finished (crash or error)
+        conn.execute("UPDATE import_job_items SET status = 'pending' WHERE job_id = ? AND status = 'running'",
+                     (job_id,))
+        conn.commit()
+        job = conn.execute("SELECT * FROM import_jobs WHERE id = ?", (job_id,)).fetchone()
+        total = job['total']
+        completed = job['processed']
+        successful = job['successful']
+        print(f"Running import job {job_id}: {total - completed} of {total} destinations left")
+
+        start_coords = geocode_address(job['start_address'])
+        if not start_coords:
+            error = f"Could not geocode start address: {job['start_address']}"
+            print(f"Import job {job_id} failed: {error}")
+            finish_import_job(conn, job_id, 'failed', error)
+            publish_import_job_event(job_id, {'type': 'error', 'error': error})
+            return
+
+        matrix_mode = job['mode'] == 'matrix'
+        worker = geocode_upload_address if matrix_mode else partial(process_upload_address, start_coords)
+        geocoded = []
+        batch = []
+        last_flush = time.monotonic()
+
+        def add_result(line, result):
+            nonlocal completed
+            completed += 1
+            message = {
+                'type': 'progress',
+                'progress': (completed * 100) // total,
+                'current': completed,
+                'total': total,
+                'address': result['address'],
+                'success': result['success']
+            }
+            if not result['success']:
+                message['error'] = result['error']
+            batch.append((line, result, message))
+
+        def route_geocoded():
+            # Matrix mode: route the geocoded destinations collected so far in one call
+            lines = [line for line, _ in geocoded]
+            for line, result in zip(lines, route_matrix_results(start_coords, [result for _, result in geocoded])):
+                add_result(line, result)
+            geocoded.clear()
+
+        def flush_batch():
+            nonlocal successful
+            if not batch:
+                return
+            messages = []
+            for line, result, message in batch:
+                if result['success']:
+                    route_data = result['route_data']
+                    route_id = insert_route(conn, job['start_address'], result['address'],
+                                            route_data.get('distance', 0),
+                                            datetime.now().strftime('%Y-%m-%d %H:%M:%S'), None,
+                                            route_data.get('route_key'), route_data['geometry'])
+                    conn.execute("""UPDATE import_job_items SET status = 'done', route_id = ?
+                                    WHERE job_id = ? AND line = ?""", (route_id, job_id, line))
+                    successful += 1
+                else:
+                    conn.execute("""UPDATE import_job_items SET status = 'failed', error = ?
+                                    WHERE job_id = ? AND line = ?""", (result['error'], job_id, line))
+                messages.append(message)
+            conn.execute("UPDATE import_jobs SET processed = ?, successful = ?, updated_at = ? WHERE id = ?",
+                         (completed, successful, time.time(), job_id))
+            conn.commit()
+            print(f"Saved batch of {len(batch)} results for import job {job_id}")
+            batch.clear()
+            for message in messages:
+                publish_import_job_event(job_id, message)
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            items = claim_import_items(conn, job_id)
+            in_flight = {}
 
-def restore_database(backup_file):
-    try:
-        shutil.copy2(backup_file, 'routes.db')
-        return True
+            def submit_next():
+                item = next(items, None)
+                if item is not None:
+                    line, address = item
+                    in_flight[executor.submit(worker, address)] = line
+
+            for _ in range(UPLOAD_WORKERS * 2):
+                submit_next()
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    line = in_flight.pop(future)
+                    if job_id not in cancelled_import_jobs:
+                        submit_next()
+                    result = future.result()
+                    if matrix_mode and result['success']:
+                        geocoded.append((line, result))
+                    else:
+                        add_result(line, result)
+
+                if len(geocoded) >= MATRIX_BATCH_SIZE or (geocoded and not in_flight):
+                    route_geocoded()
+                if len(batch) >= UPLOAD_BATCH_SIZE or time.monotonic() - last_flush >= UPLOAD_FLUSH_INTERVAL:
+                    flush_batch()
+                    last_flush = time.monotonic()
+        flush_batch()
+
+        if job_id in cancelled_import_jobs:
+            print(f"Import job {job_id} cancelled after {completed} of {total}")
+            publish_import_job_event(job_id, {'type': 'cancelled', 'current': completed, 'total': total})
+            return
+        finish_import_job(conn, job_id, 'completed')
+        print(f"Import job {job_id} complete. {successful} successful out of {total}")
+        publish_import_job_event(job_id, {'type': 'complete', 'successful': successful, 'total': total})
     except Exception as e:
-        print(f"Restore error: {e}")
-        return False
+        print(f"Fatal error in import job {job_id}: {str(e)}")
+        conn.rollback()
+        finish_import_job(conn, job_id, 'failed', str(e))
+        publish_import_job_event(job_id, {'type': 'error', 'error': f'Error processing file: {str(e)}'})
+    finally:
+        with import_job_lock:
+            running_import_jobs.discard(job_id)
+            cancelled_import_jobs.discard(job_id)
+        conn.close()
 
-def export_to_csv():
-    conn = get_db()
-    cursor = conn.cursor()
-    
+def resume_import_jobs():
+    # Requeue jobs that were queued or running when the process stopped
+    conn = connect_db()
     try:
-        # Get all routes but exclude route_points column
-        routes = cursor.execute("SELECT id, start_address, end_address, distance, date, notes FROM routes ORDER BY date DESC").fetchall()
-        
-        # Create a temporary file in system temp directory
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.csv', mode='w', newline='', encoding='utf-8')
-        
-        # Write to CSV
-        writer = csv.writer(temp_file)
-        writer.writerow(['ID', 'Start Address', 'End Address', 'Distance (km)', 'Date', 'Notes'])  # Headers
-        writer.writerows(routes)
-        
-        temp_file.close()
-        return temp_file.name
-        
-    except Exception as e:
-        print(f"Error in export_to_csv: {e}")
-        if 'temp_file' in locals():
-            temp_file.close()
-            try:
-                os.unlink(temp_file.name)
-            except:
-                pass
-        raise
+        job_ids = [row['id'] for row in conn.execute(
+            "SELECT id FROM import_jobs WHERE status IN ('queued', 'running') ORDER BY created_at")]
     finally:
         conn.close()
+    for job_id in job_ids:
+        print(f"Resuming import job {job_id}")
+        import_job_executor.submit(run_import_job, job_id)
+    return job_ids
 
-def geocode_address(address):
+def geocode_upload_address(address):
+    # Matrix mode worker: only the destination's coordinates are needed
     try:
-        url = f"https://api.opencagedata.com/geocode/v1/json?q={address}&key={OPENCAGE_API_KEY}"
-        response = requests.get(url)
-        data = response.json()
-        if data['results']:
-            location = data['results'][0]['geometry']
-            return [location['lat'], location['lng']]
-        return None
+        coords = geocode_address(address)
+        if not coords:
+            return {'address': address, 'success': False, 'error': 'Could not geocode address'}
+        return {'address': address, 'success': True, 'coords': coords}
     except Exception as e:
-        print(f"Geocoding error: {e}")
-        return None
+        print(f"Error geocoding address {address}: {str(e)}")
+        return {'address': address, 'success': False, 'error': str(e)}
 
-def calculate_route(start_coords, end_coords):
+def route_matrix_results(start_coords, geocoded):
+    # Distances for a chunk of geocoded destinations. Fresh route cache
+    # entries are used as they are; the rest share one matrix call and get
+    # endpoint-only geometry, filled in later by fill_route_geometry.
+    results = [None] * len(geocoded)
+    misses = []
+    conn = get_db()
+    for i, result in enumerate(geocoded):
+        route_key = route_cache_key(start_coords, result['coords'])
+        cached = conn.execute("SELECT distance, route_points, computed_at FROM route_cache WHERE route_key = ?",
+                              (route_key,)).fetchone()
+        if cached and cached['computed_at'] > time.time() - ROUTE_CACHE_TTL:
+            count_cache_event(route_cache_stats, 'hits')
+            geometry = prepare_route_geometry(decode_route_points(cached['route_points']))
+            route_data = {'distance': cached['distance'], 'route_key': route_key, 'geometry': geometry}
+            results[i] = {'address': result['address'], 'success': True, 'route_data': route_data}
+        else:
+            misses.append((i, route_key))
+
+    if misses:
+        try:
+            distances = request_route_matrix(start_coords, [geocoded[i]['coords'] for i, _ in misses])
+        except Exception as e:
+            print(f"Route matrix error: {e}")
+            distances = [None] * len(misses)
+            error = f'Could not calculate route: {e}'
+        else:
+            error = 'Could not calculate route'
+        for (i, route_key), distance in zip(misses, distances):
+            result = geocoded[i]
+            if distance is None:
+                results[i] = {'address': result['address'], 'success': False, 'error': error}
+            else:
+                route_data = {'distance': distance, 'route_key': route_key,
+                              'geometry': endpoint_geometry(start_coords, result['coords'])}
+                results[i] = {'address': result['address'], 'success': True, 'route_data': route_data}
+    return results
+
+def fill_route_geometry(conn, limit=LAZY_GEOMETRY_LIMIT):
+    # Fetch full geometry (through the route cache) for routes stored with
+    # only their endpoints. Failed routes back off so they don't hold up
+    # newer ones. Returns the number of routes updated.
+    now = time.time()
+    rows = conn.execute("""SELECT r.id, r.start_lat, r.start_lon, r.end_lat, r.end_lon,
+                                  COALESCE(f.attempts, 0) AS attempts
+                           FROM routes r
+                           LEFT JOIN geometry_fetch_failures f ON f.route_id = r.id
+                           WHERE r.geometry_id IS NULL AND r.start_lat IS NOT NULL
+                             AND (f.retry_at IS NULL OR f.retry_at <= ?)
+                           ORDER BY r.id LIMIT ?""", (now, limit)).fetchall()
+    if not rows:
+        return 0
+
+    def fetch(row):
+        route_data = calculate_route((row['start_lat'], row['start_lon']), (row['end_lat'], row['end_lon']))
+        return row, prepare_route_geometry(route_data['points']) if route_data else None
+
+    # Fetch everything before writing: the workers store into route_cache on
+    # their own connections, which an open write transaction here would block
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        results = list(executor.map(fetch, rows))
+
+    updated = 0
+    for row, geometry in results:
+        if geometry is not None:
+            update_route_geometry(conn, row['id'], geometry)
+            if row['attempts']:
+                conn.execute("DELETE FROM geometry_fetch_failures WHERE route_id = ?", (row['id'],))
+            updated += 1
+        else:
+            delay = min(LAZY_GEOMETRY_RETRY * 2 ** row['attempts'], 86400)
+            conn.execute("""INSERT OR REPLACE INTO geometry_fetch_failures (route_id, attempts, retry_at)
+                            VALUES (?, ?, ?)""", (row['id'], row['attempts'] + 1, now + delay))
+    conn.commit()
+    print(f"Fetched geometry for {updated} of {len(rows)} routes")
+    return updated
+
+geometry_fill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='geometry-fill')
+geometry_fill_lock = threading.Lock()
+geometry_fill_queued = False
+
+def fill_route_geometry_in_background():
+    # At most one fill runs or waits at a time; /get_map never waits for it
+    global geometry_fill_queued
+    with geometry_fill_lock:
+        if geometry_fill_queued:
+            return
+        geometry_fill_queued = True
+    geometry_fill_executor.submit(run_geometry_fill)
+
+def run_geometry_fill():
+    global geometry_fill_queued
+    conn = connect_db()
     try:
-        url = f"https://graphhopper.com/api/1/route?point={start_coords[0]},{start_coords[1]}&point={end_coords[0]},{end_coords[1]}&vehicle=car&points_encoded=false&key={GRAPHHOPPER_API_KEY}"
-        response = requests.get(url)
-        data = response.json()
-        if 'paths' in data and data['paths']:
-            path = data['paths'][0]
-            return {
-                'distance': path['distance'] / 1000,  # Convert to kilometers
-                'points': path['points']['coordinates']  # List of [lon, lat] coordinates
-            }
-        return None
+        with metrics.timer('map_render', step='geometry'):
+            fill_route_geometry(conn)
     except Exception as e:
-        print(f"Route calculation error: {e}")
-        return None
+        print(f"Error fetching route geometry: {str(e)}")
+    finally:
+        conn.close()
+        with geometry_fill_lock:
+            geometry_fill_queued = False
 
 def get_last_update_time():
     try:
-        conn = sqlite3.connect('routes.db')
-        c = conn.cursor()
-        result = c.execute('SELECT MAX(date) as last_update FROM routes').fetchone()
-        conn.close()
+        result = get_db().execute('SELECT MAX(date) as last_update FROM routes').fetchone()
         return result['last_update'] if result['last_update'] else None
     except:
         return None
 
-def should_regenerate_map():
-    cache_file = os.path.join(os.path.dirname(__file__), 'static', 'map_last_update.txt')
-    routes_file = os.path.join(os.path.dirname(__file__), 'routes.db')
-    
-    # If no cache file exists, regenerate
-    if not os.path.exists(cache_file):
+# token/version/level describe the per-route fragments; html_token/zoom the rendered page
+map_cache = {'token': None, 'version': 0, 'level': None, 'fragments': {},
+             'html_token': None, 'zoom': None, 'html': None}
+map_cache_lock = threading.Lock()
+
+MAP_ROUTES_SCRIPT = """
+(function(map) {
+    var routes = %s;
+    var startIcon = L.AwesomeMarkers.icon({markerColor: 'green', iconColor: 'white', icon: 'play', prefix: 'glyphicon'});
+    var endIcon = L.AwesomeMarkers.icon({markerColor: 'red', iconColor: 'white', icon: 'stop', prefix: 'glyphicon'});
+    var lines = [];
+    routes.forEach(function(route) {
+        L.marker(route.start, {icon: startIcon}).bindPopup(route.start_popup).addTo(map);
+        L.marker(route.end, {icon: endIcon}).bindPopup(route.end_popup).addTo(map);
+        lines.push(route.line);
+    });
+    L.polyline(lines, {color: 'blue', weight: 2, opacity: 0.8}).addTo(map);
+})(%s);
+"""
+
+def get_routes_version(conn):
+    # (token, version): the token combines the database identity and version
+    version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM routes_changelog").fetchone()[0]
+    db_id = conn.execute("SELECT value FROM app_meta WHERE key = 'db_id'").fetchone()
+    return f"{db_id[0] if db_id else 'none'}-{version}", version
+
+def should_regenerate_map(token, zoom):
+    # The map on disk is reusable if it was built from the same data version and zoom
+    if not os.path.exists(MAP_CACHE_FILE):
         return True
-    
-    # Read last map update time
-    with open(cache_file, 'r') as f:
+    try:
+        with open(MAP_CACHE_META_FILE, 'r') as f:
+            meta = json.load(f)
+    except (ValueError, OSError):
+        return True
+    return meta.get('token') != token or meta.get('zoom') != zoom
+
+def map_route_line(conn, route, level):
+    # A route's [lat, lon] line at the given level, or None without geometry
+    if route['lod_points'] is not None:
+        route_points = decode_route_points(route['lod_points'])
+    else:
+        route_points = decode_route_points(route['raw_points'])
+        if level and len(route_points):
+            # Build missing levels once (rows from older versions)
+            lods = build_route_lods(route_points)
+            store_geometry_lods(conn, route['geometry_id'], lods)
+            route_points = decode_route_points(lods[level - 1][1])
+    if not len(route_points):
+        return None
+    # Swap [lon, lat] to the [lat, lon] order Leaflet expects
+    return route_points[:, ::-1].tolist()
+
+def build_map_fragment(conn, route, level, lines=None):
+    # One route's markers and line as a JSON snippet for MAP_ROUTES_SCRIPT.
+    # lines memoizes decoded geometry by id, since routes share it.
+    if lines is None or route['geometry_id'] is None:
+        line = map_route_line(conn, route, level)
+    elif route['geometry_id'] in lines:
+        line = lines[route['geometry_id']]
+    else:
+        line = lines[route['geometry_id']] = map_route_line(conn, route, level)
+    if not line:
+        return None
+
+    return json.dumps({
+        'start': line[0],
+        'end': line[-1],
+        'start_popup': html.escape(f"Start: {route['start_address']}"),
+        'end_popup': html.escape(f"End: {route['end_address']}"),
+        'line': line
+    }, separators=(',', ':'))
+
+def update_map_fragments(conn, token, version, level):
+    # Bring map_cache['fragments'] up to date, re-reading only changed routes
+    # when possible. Returns the number of routes (re)built.
+    query = """SELECT r.id, r.start_address, r.end_address, r.geometry_id, l.route_points AS lod_points,
+                      CASE WHEN l.route_points IS NULL THEN g.route_points END AS raw_points
+               FROM routes r
+               LEFT JOIN route_geometry g ON g.id = r.geometry_id
+               LEFT JOIN geometry_lods l ON l.geometry_id = r.geometry_id AND l.level = ?"""
+    fragments = map_cache['fragments']
+    changed = None
+    cached_db = map_cache['token'].rsplit('-', 1)[0] if map_cache['token'] else None
+    if map_cache['token'] == token and map_cache['level'] == level:
+        changed = []
+    elif cached_db == token.rsplit('-', 1)[0] and map_cache['level'] == level:
+        oldest = conn.execute("SELECT MIN(version) FROM routes_changelog").fetchone()[0]
+        if oldest is not None and oldest <= map_cache['version'] + 1:
+            changed = [row[0] for row in conn.execute(
+                "SELECT DISTINCT route_id FROM routes_changelog WHERE version > ?", (map_cache['version'],))]
+            if len(changed) > MAP_INCREMENTAL_LIMIT:
+                changed = None
+
+    if changed is None:
+        fragments.clear()
+        rows = conn.execute(query, (level,)).fetchall()
+    else:
+        for route_id in changed:
+            fragments.pop(route_id, None)
+        rows = []
+        if changed:
+            placeholders = ','.join('?' * len(changed))
+            rows = conn.execute(f"{query} WHERE r.id IN ({placeholders})", (level, *changed)).fetchall()
+
+    lines = {}
+    for route in rows:
         try:
-            last_map_update = datetime.fromisoformat(f.read().strip())
-        except (ValueError, FileNotFoundError):
-            return True
-    
-    # Get routes database modification time
-    routes_mod_time = datetime.fromtimestamp(os.path.getmtime(routes_file))
-    
-    # Regenerate if routes have been modified since last map update
-    return routes_mod_time > last_map_update
+            fragment = build_map_fragment(conn, route, level, lines)
+            if fragment:
+                fragments[route['id']] = fragment
+        except (ValueError, zlib.error, TypeError, KeyError) as e:
+            print(f"Error processing route points for route: {route['id']} - {str(e)}")
+    conn.commit()
 
-def get_db():
-    conn = sqlite3.connect('routes.db')
+    map_cache.update({'token': token, 'version': version, 'level': level})
+    conn.execute("DELETE FROM routes_changelog WHERE version < ?", (version - MAP_CHANGELOG_KEEP,))
+    conn.commit()
+    return len(rows)
+
+tile_cache = LRUCache(TILE_CACHE_SIZE)
+
+def parse_bbox(value):
+    # "min_lon,min_lat,max_lon,max_lat" -> tuple of floats
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4 or parts[0] > parts[2] or parts[1] > parts[3]:
+        raise ValueError('bbox must be min_lon,min_lat,max_lon,max_lat')
+    return tuple(parts)
+
+def tile_bounds(z, x, y):
+    # Web Mercator (slippy map) tile -> (min_lon, min_lat, max_lon, max_lat)
+    n = 2 ** z
+
+    def tile_lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return (x / n * 360 - 180, tile_lat(y + 1), (x + 1) / n * 360 - 180, tile_lat(y))
+
+def clip_route_points(points, bbox):
+    # Runs of consecutive segments whose extent intersects bbox, as separate
+    # lines. Conservative: segments are kept whole, not cut at the boundary.
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if len(points) < 2:
+        inside = len(points) and min_lon <= points[0][0] <= max_lon and min_lat <= points[0][1] <= max_lat
+        return [points] if inside else []
+    seg_min = np.minimum(points[:-1], points[1:])
+    seg_max = np.maximum(points[:-1], points[1:])
+    hit = ((seg_max[:, 0] >= min_lon) & (seg_min[:, 0] <= max_lon) &
+           (seg_max[:, 1] >= min_lat) & (seg_min[:, 1] <= max_lat))
+    segments = np.flatnonzero(hit)
+    if not len(segments):
+        return []
+    breaks = np.flatnonzero(np.diff(segments) > 1)
+    starts = np.concatenate(([segments[0]], segments[breaks + 1]))
+    ends = np.concatenate((segments[breaks], [segments[-1]]))
+    return [points[start:end + 2] for start, end in zip(starts, ends)]
+
+def route_feature(route, geometry):
+    return {
+        'type': 'Feature',
+        'id': route['id'],
+        'geometry': geometry,
+        'properties': {
+            'id': route['id'],
+            'start': route['start_address'],
+            'end': route['end_address'],
+            'distance': route['distance'],
+            'date': route['date']
+        }
+    }
+
+# Ids of routes whose bounding box intersects (min_lon, max_lon, min_lat, max_lat)
+RTREE_BBOX_QUERY = "SELECT id FROM routes_rtree WHERE max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?"
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * np.arcsin(np.sqrt(a))
+
+def nearest_route_endpoints(conn, lat, lon, n, kind):
+    # Grow a search box around the point until it holds n candidates whose
+    # distances are all covered by the box, so nothing outside can be closer.
+    # Returns [(distance_km, route_id, kind)] sorted by distance.
+    kinds = {'start': (0,), 'end': (1,), 'any': (0, 1)}[kind]
+    radius = 0.01
+    while True:
+        lon_radius = min(180.0, radius / max(math.cos(math.radians(lat)), 0.01))
+        rows = conn.execute("""SELECT id, min_lon, min_lat FROM route_endpoints_rtree
+                                WHERE max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?""",
+                             (lon - lon_radius, lon + lon_radius, lat - radius, lat + radius)).fetchall()
+        rows = [row for row in rows if row[0] % 2 in kinds]
+        if rows:
+            ids = np.array([row[0] for row in rows])
+            distances = haversine_km(lat, lon, np.array([row[2] for row in rows]), np.array([row[1] for row in rows]))
+            order = np.argsort(distances)[:n]
+            # The box is guaranteed to contain everything within radius degrees of latitude
+            covered_km = radius * 111.0
+            if radius >= 180 or (len(order) == n and distances[order[-1]] <= covered_km):
+                return [(float(distances[i]), int(ids[i]) // 2, 'start' if ids[i] % 2 == 0 else 'end') for i in order]
+        elif radius >= 180:
+            return []
+        radius = min(radius * 4, 180.0)
+
+def render_map_html(zoom):
+    # Create map with all routes
+    # Use a default center that makes sense (e.g., US center)
+    m = folium.Map(location=[39.8283, -98.5795], zoom_start=zoom)
+    routes_json = '[' + ','.join(map_cache['fragments'][route_id] for route_id in sorted(map_cache['fragments'])) + ']'
+    m.get_root().script.add_child(folium.Element(MAP_ROUTES_SCRIPT % (routes_json, m.get_name())))
+    return m._repr_html_()
+
+def connect_db():
+    # sqlite3 keeps a per-connection cache of prepared statements, so reusing
+    # connections (below) also reuses compiled queries
+    conn = sqlite3.connect(DATABASE_PATH, timeout=SQLITE_BUSY_TIMEOUT, factory=InstrumentedConnection,
+                           cached_statements=SQLITE_STATEMENT_CACHE, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+thread_db = threading.local()
+
+def get_db():
+    # Request handlers share one connection per app context, closed on teardown.
+    # Other threads (upload workers, streaming generators) keep one per thread.
+    if has_app_context():
+        if 'db' not in g:
+            g.db = connect_db()
+        return g.db
+    conn = getattr(thread_db, 'conn', None)
+    if conn is None:
+        conn = thread_db.conn = connect_db()
     return conn
 
+@app.teardown_appcontext
+def close_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+
 def after_this_request(func):
     if not hasattr(g, 'call_after_request'):
         g.call_after_request = []
     g.call_after_request.append(func)
     return func
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if PROFILE_REQUESTS:
+        g.request_profile = profiled(f"{request.method} {request.endpoint or request.path}")
+        g.request_profile.__enter__()
+
+@app.after_request
+def record_request_metrics(response):
+    # Streaming responses are timed until the handler returns, not until the
+    # last chunk is sent
+    profile = g.pop('request_profile', None)
+    if profile is not None:
+        profile.__exit__(None, None, None)
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        metrics.observe('http_request_seconds', time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        metrics.inc('http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
 @app.after_request
 def per_request_callbacks(response):
     for func in getattr(g, 'call_after_request', ()):
@@ -178,30 +2916,72 @@ def add_route():
         route_data = calculate_route(start_coords, end_coords)
         if route_data:
             conn = get_db()
-            conn.execute("""INSERT INTO routes 
-                        (start_address, end_address, distance, date, notes, route_points) 
-                        VALUES (?, ?, ?, date('now'), ?, ?)""",
-                     (start_address, end_address, route_data['distance'], notes, 
-                      json.dumps(route_data['points'])))
+            insert_route(conn, start_address, end_address, route_data['distance'], None, notes,
+                         route_data['route_key'], prepare_route_geometry(route_data['points']))
             conn.commit()
-            conn.close()
             return jsonify({'success': True, 'distance': route_data['distance']})
     
     return jsonify({'success': False, 'error': 'Could not calculate route'})
 
+def encode_routes_cursor(value, route_id):
+    return base64.urlsafe_b64encode(json.dumps([value, route_id]).encode('utf-8')).decode('ascii')
+
+def decode_routes_cursor(cursor):
+    value, route_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return value, int(route_id)
+
 @app.route('/get_routes')
 def get_routes():
+    # One keyset page of the routes table: ?sort=date|distance|start|end,
+    # ?direction=asc|desc, ?q= text filter, ?limit=, and ?cursor= taken from
+    # the previous page's next_cursor. Never reads route_points.
+    sort = request.args.get('sort', 'date')
+    direction = request.args.get('direction', 'desc').lower()
+    if sort not in ROUTE_SORT_COLUMNS or direction not in ('asc', 'desc'):
+        return jsonify({'success': False, 'error': 'Invalid sort or direction'}), 400
+    limit = max(1, min(request.args.get('limit', ROUTES_PAGE_SIZE, type=int), ROUTES_MAX_PAGE_SIZE))
+    sort_expression = ROUTE_SORT_COLUMNS[sort]
+
+    conditions = []
+    params = []
+    if request.args.get('cursor'):
+        try:
+            cursor_value, cursor_id = decode_routes_cursor(request.args['cursor'])
+        except (ValueError, TypeError):
+            return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+        comparison = '<' if direction == 'desc' else '>'
+        conditions.append(f"({sort_expression}, id) {comparison} (?, ?)")
+        params += [cursor_value, cursor_id]
+    query_text = request.args.get('q', '').strip()
+    if query_text:
+        pattern = '%' + query_text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        conditions.append("(start_address LIKE ? ESCAPE '\\' OR end_address LIKE ? ESCAPE '\\' OR notes LIKE ? ESCAPE '\\')")
+        params += [pattern, pattern, pattern]
+
+    query = f"SELECT id, start_address, end_address, distance, date, notes, {sort_expression} AS sort_value FROM routes"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY {sort_expression} {direction}, id {direction} LIMIT ?"
+    params.append(limit + 1)
+
     conn = get_db()
-    routes = conn.execute("SELECT * FROM routes ORDER BY date DESC").fetchall()
-    conn.close()
-    return jsonify([{
-        'id': route['id'], 
-        'start': route['start_address'], 
-        'end': route['end_address'], 
-        'distance': route['distance'], 
-        'date': route['date'], 
-        'notes': route['notes'] or ''
-    } for route in routes])
+    routes = conn.execute(query, params).fetchall()
+
+    next_cursor = None
+    if len(routes) > limit:
+        routes = routes[:limit]
+        next_cursor = encode_routes_cursor(routes[-1]['sort_value'], routes[-1]['id'])
+    return jsonify({
+        'routes': [{
+            'id': route['id'], 
+            'start': route['start_address'], 
+            'end': route['end_address'], 
+            'distance': route['distance'], 
+            'date': route['date'], 
+            'notes': route['notes'] or ''
+        } for route in routes],
+        'next_cursor': next_cursor
+    })
 
 @app.route('/delete_route/<int:route_id>', methods=['DELETE'])
 def delete_route(route_id):
@@ -233,21 +3013,38 @@ def update_route(route_id):
                             end_address = ?, 
                             distance = ?,
                             notes = ?,
-                            route_points = ?
+                            route_key = ?
                         WHERE id = ?""", 
                      (start_address, end_address, route_data['distance'], notes,
-                      json.dumps(route_data['points']), route_id))
+                      route_data['route_key'], route_id))
+            update_route_geometry(conn, route_id, prepare_route_geometry(route_data['points']))
             conn.commit()
-            conn.close()
             return jsonify({'success': True})
     
     return jsonify({'success': False, 'error': 'Could not calculate new route'})
 
 @app.route('/backup_database', methods=['POST'])
 def backup_db():
-    backup_path = backup_database()
+    # ?compress=0|1 overrides BACKUP_COMPRESS; ?background=1 returns at once
+    # and the file appears in /get_backups when complete
+    compress = request.args.get('compress', '1' if BACKUP_COMPRESS else '0') == '1'
+    backup_path = new_backup_path(compress)
+    try:
+        if request.args.get('background') == '1':
+            backup_executor.submit(run_backup_in_background, open_backup_snapshot(), backup_path)
+            return jsonify({'success': True, 'backup_path': backup_path, 'pending': True}), 202
+        backup_database(backup_path=backup_path)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Backup error: {e}")
+        return jsonify({'success': False, 'error': 'Backup failed'}), 500
     return jsonify({'success': True, 'backup_path': backup_path})
 
+@app.route('/get_backups')
+def get_backups():
+    with backup_progress_lock:
+        running = [dict(progress, name=name) for name, progress in backup_progress.items()]
+    return jsonify({'backups': list_backups(), 'running': running, 'keep': BACKUP_KEEP})
+
 @app.route('/restore_database', methods=['POST'])
 def restore_db():
     if 'backup_file' not in request.files:
@@ -257,136 +3054,303 @@ def restore_db():
     if file.filename == '':
         return jsonify({'success': False, 'error': 'No file selected'})
     
-    backup_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_backup.db')
-    file.save(backup_path)
-    
-    if restore_database(backup_path):
-        os.remove(backup_path)
-        return jsonify({'success': True})
-    else:
-        return jsonify({'success': False, 'error': 'Restore failed'})
+    # Hidden .partial names keep uploads out of /get_backups and rotation
+    backup_path = os.path.join(get_backup_dir(), f'.restore_{uuid.uuid4().hex}.partial')
+    try:
+        file.save(backup_path)
+        error = restore_database(backup_path)
+    finally:
+        if os.path.exists(backup_path):
+            os.remove(backup_path)
+
+    if error:
+        return jsonify({'success': False, 'error': error})
+    return jsonify({'success': True})
 
 @app.route('/export_csv')
 def export_csv():
+    # ?format=csv|parquet|arrow, ?gzip=1 (CSV only), ?columns=id,date,...,
+    # ?start_date / ?end_date (YYYY-MM-DD, inclusive)
     try:
-        temp_file_path = export_to_csv()
-        
-        @after_this_request
-        def cleanup(response):
-            try:
-                os.unlink(temp_file_path)
-                print(f"Successfully deleted temporary file: {temp_file_path}")
-            except Exception as e:
-                print(f"Error cleaning up temporary file: {e}")
-            return response
-        
-        return send_file(
-            temp_file_path,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'routes_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        )
-        
+        file_format = request.args.get('format', 'csv').lower()
+        if file_format not in EXPORT_FORMATS:
+            return jsonify({'error': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
+        if file_format != 'csv' and pa is None:
+            return jsonify({'error': f'{file_format} export requires pyarrow'}), 400
+
+        columns = [c.strip() for c in request.args.get('columns', '').split(',') if c.strip()] or list(EXPORT_COLUMNS)
+        unknown = [c for c in columns if c not in EXPORT_COLUMNS]
+        if unknown:
+            return jsonify({'error': f"Unknown columns: {', '.join(unknown)}"}), 400
+
+        dates = {}
+        for name in ('start_date', 'end_date'):
+            value = request.args.get(name)
+            if value:
+                try:
+                    dates[name] = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+                except ValueError:
+                    return jsonify({'error': f'{name} must be YYYY-MM-DD'}), 400
+
+        query, params = build_export_query(columns, **dates)
+        filename = f'routes_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+        if file_format == 'csv':
+            compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+            body = export_to_csv(columns, query, params, compress)
+            mimetype = 'application/gzip' if compress else 'text/csv'
+            filename += '.csv.gz' if compress else '.csv'
+        else:
+            body = export_to_arrow(columns, query, params, file_format)
+            mimetype = 'application/vnd.apache.parquet' if file_format == 'parquet' else 'application/vnd.apache.arrow.stream'
+            filename += '.parquet' if file_format == 'parquet' else '.arrows'
+
+        response = Response(body, mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+        return response
+
     except Exception as e:
         print(f"Export error: {e}")
         return jsonify({'error': 'Failed to export CSV'}), 500
 
 @app.route('/clear_database', methods=['POST'])
 def clear_db():
-    backup_database()  # Create backup before clearing
+    # The backup's snapshot is taken before the delete, so it can be copied
+    # in the background and still holds the cleared routes
+    backup_path = new_backup_path()
+    backup_executor.submit(run_backup_in_background, open_backup_snapshot(), backup_path)
     conn = get_db()
     conn.execute("DELETE FROM routes")
+    conn.execute("DELETE FROM geometry_fetch_failures")
     conn.commit()
-    conn.close()
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'backup_path': backup_path})
 
 @app.route('/get_map')
 def get_map():
     try:
-        # Connect to database and fetch routes
+        zoom = request.args.get('zoom', MAP_DEFAULT_ZOOM, type=int)
+        level = zoom_to_lod(zoom)
+
         conn = get_db()
-        routes = conn.execute("SELECT * FROM routes ORDER BY date DESC").fetchall()
-        conn.close()
-        
-        # If no routes, return empty map
-        if not routes:
-            return jsonify({'html': '<div class="text-center">No routes to display</div>'})
-        
-        # Create map with all routes
-        # Use a default center that makes sense (e.g., US center)
-        m = folium.Map(location=[39.8283, -98.5795], zoom_start=4)
-        
-        # Add route points to map
-        for route in routes:
-            try:
-                # Ensure route_points is parsed correctly
-                route_points = json.loads(route['route_points']) if route['route_points'] else []
+        token, version = get_routes_version(conn)
+        etag = f"map-{token}-z{zoom}"
+        # Routes stored without geometry get it in the background once the
+        # map is asked for. The updates change the version, so a later
+        # request draws them.
+        fill_route_geometry_in_background()
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'})
+
+        regenerated = False
+        rebuilt = 0
+        with map_cache_lock:
+            if map_cache['html_token'] == token and map_cache['zoom'] == zoom:
+                map_html = map_cache['html']
+            elif not should_regenerate_map(token, zoom):
+                # e.g. a restarted app reusing the map rendered by a previous run
+                with open(MAP_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    map_html = f.read()
+                map_cache.update({'html': map_html, 'html_token': token, 'zoom': zoom})
+            else:
+                with metrics.timer('map_render', step='fragments'):
+                    rebuilt = update_map_fragments(conn, token, version, level)
                 
-                if route_points:
-                    # Swap latitude and longitude to ensure correct order (lon, lat)
-                    corrected_route_points = [[point[1], point[0]] for point in route_points]
-                    
-                    # Add markers and route line
-                    start_coords = corrected_route_points[0]
-                    end_coords = corrected_route_points[-1]
-                    
-                    folium.Marker(
-                        location=start_coords, 
-                        popup=f"Start: {route['start_address']}",
-                        icon=folium.Icon(color='green', icon='play')
-                    ).add_to(m)
-                    
-                    folium.Marker(
-                        location=end_coords, 
-                        popup=f"End: {route['end_address']}",
-                        icon=folium.Icon(color='red', icon='stop')
-                    ).add_to(m)
-                    
-                    # Draw route line
-                    folium.PolyLine(
-                        locations=corrected_route_points, 
-                        color='blue', 
-                        weight=2, 
-                        opacity=0.8
-                    ).add_to(m)
-            except (json.JSONDecodeError, TypeError, KeyError) as e:
-                print(f"Error processing route points for route: {route['id']} - {str(e)}")
-        
-        # Generate map HTML
-        map_html = m._repr_html_()
-        
-        # Save map to cached HTML (optional, but can improve performance)
-        cached_map_path = os.path.join(os.path.dirname(__file__), 'static', 'cached_map.html')
-        with open(cached_map_path, 'w', encoding='utf-8') as f:
-            f.write(map_html)
-        
-        # Update last update time
-        with open(os.path.join(os.path.dirname(__file__), 'static', 'map_last_update.txt'), 'w') as f:
-            f.write(datetime.now().isoformat())
-        
-        return jsonify({'html': map_html, 'regenerated': True})
+                # If no routes, return empty map
+                if not map_cache['fragments']:
+                    map_html = '<div class="text-center">No routes to display</div>'
+                else:
+                    with metrics.timer('map_render', step='folium'):
+                        map_html = render_map_html(zoom)
+                map_cache.update({'html': map_html, 'html_token': token, 'zoom': zoom})
+                regenerated = True
+                
+                # Save map to cached HTML so a restarted app can serve it directly
+                with open(MAP_CACHE_FILE, 'w', encoding='utf-8') as f:
+                    f.write(map_html)
+                with open(MAP_CACHE_META_FILE, 'w') as f:
+                    json.dump({'token': token, 'zoom': zoom, 'updated': datetime.now().isoformat()}, f)
+
+        response = jsonify({'html': map_html, 'regenerated': regenerated, 'routes_rebuilt': rebuilt,
+                            'zoom': zoom, 'lod': level})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     
     except Exception as e:
         print(f"Error generating map: {str(e)}")
         return jsonify({'error': 'Failed to generate map', 'details': str(e)})
 
+@app.route('/get_routes_geojson')
+def get_routes_geojson():
+    # Streams one page of routes as a GeoJSON FeatureCollection. Optional
+    # ?bbox=min_lon,min_lat,max_lon,max_lat keeps routes whose bounding box
+    # intersects it, ?zoom picks a simplified level, and ?cursor continues
+    # from the previous page's next_cursor.
+    try:
+        bbox = parse_bbox(request.args['bbox']) if request.args.get('bbox') else None
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    zoom = request.args.get('zoom', type=int)
+    level = zoom_to_lod(zoom, headroom=0) if zoom is not None else 0
+    limit = min(request.args.get('limit', GEOJSON_PAGE_SIZE, type=int), GEOJSON_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor', 0, type=int)
+
+    query = """SELECT r.id, r.start_address, r.end_address, r.distance, r.date,
+                      COALESCE(l.route_points, g.route_points) AS route_points
+               FROM routes r
+               LEFT JOIN route_geometry g ON g.id = r.geometry_id
+               LEFT JOIN geometry_lods l ON l.geometry_id = r.geometry_id AND l.level = ?
+               WHERE r.id > ?"""
+    params = [level, cursor]
+    if bbox:
+        query += f" AND r.id IN ({RTREE_BBOX_QUERY})"
+        params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+    query += " ORDER BY r.id LIMIT ?"
+    params.append(limit + 1)
+
+    def generate():
+        # Runs after the request context is gone, so it owns its connection
+        conn = connect_db()
+        try:
+            yield '{"type":"FeatureCollection","features":['
+            next_cursor = None
+            for count, route in enumerate(conn.execute(query, params)):
+                if count == limit:
+                    break
+                try:
+                    points = decode_route_points(route['route_points'])
+                except (ValueError, zlib.error) as e:
+                    print(f"Error decoding route {route['id']}: {e}")
+                    continue
+                if not len(points):
+                    # Bounding box known but geometry not stored (yet)
+                    continue
+                feature = route_feature(route, {'type': 'LineString', 'coordinates': points.tolist()})
+                yield (',' if next_cursor is not None else '') + json.dumps(feature, separators=(',', ':'))
+                next_cursor = route['id']
+            else:
+                next_cursor = None
+            yield '],"next_cursor":' + json.dumps(next_cursor) + '}'
+        finally:
+            conn.close()
+
+    return Response(generate(), mimetype='application/geo+json')
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>')
+def get_tile(z, x, y):
+    # GeoJSON vector tile: routes clipped to the (buffered) tile and simplified
+    # for its zoom, plus start/end points. Tiles are cached per data version.
+    if not (0 <= z <= TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({'success': False, 'error': 'Tile out of range'}), 404
+
+    conn = get_db()
+    token, _ = get_routes_version(conn)
+    etag = f"tile-{token}-{z}-{x}-{y}"
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'})
+
+    found, payload = tile_cache.get((token, z, x, y))
+    if not found:
+        min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+        pad_lon = (max_lon - min_lon) * TILE_BUFFER
+        pad_lat = (max_lat - min_lat) * TILE_BUFFER
+        clip_box = (min_lon - pad_lon, min_lat - pad_lat, max_lon + pad_lon, max_lat + pad_lat)
+        routes = conn.execute("""SELECT r.id, r.start_address, r.end_address, r.distance, r.date,
+                                        COALESCE(l.route_points, g.route_points) AS route_points
+                                 FROM routes r
+                                 LEFT JOIN route_geometry g ON g.id = r.geometry_id
+                                 LEFT JOIN geometry_lods l ON l.geometry_id = r.geometry_id AND l.level = ?
+                                 WHERE r.id IN (""" + RTREE_BBOX_QUERY + """)""",
+                              (zoom_to_lod(z, headroom=0), clip_box[0], clip_box[2], clip_box[1], clip_box[3])).fetchall()
+
+        features = []
+        for route in routes:
+            try:
+                points = decode_route_points(route['route_points'])
+            except (ValueError, zlib.error) as e:
+                print(f"Error decoding route {route['id']}: {e}")
+                continue
+            if not len(points):
+                continue
+            lines = clip_route_points(points, clip_box)
+            if lines:
+                features.append(route_feature(route, {
+                    'type': 'MultiLineString',
+                    'coordinates': [np.round(line, 6).tolist() for line in lines]
+                }))
+            for kind, point in (('start', points[0]), ('end', points[-1])):
+                if min_lon <= point[0] <= max_lon and min_lat <= point[1] <= max_lat:
+                    feature = route_feature(route, {'type': 'Point', 'coordinates': np.round(point, 6).tolist()})
+                    feature['id'] = f"{route['id']}-{kind}"
+                    feature['properties']['kind'] = kind
+                    features.append(feature)
+
+        payload = json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':'))
+        tile_cache.set((token, z, x, y), payload, math.inf)
+
+    response = Response(payload, mimetype='application/geo+json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/get_routes_in_bbox')
+def get_routes_in_bbox():
+    # Routes passing through a viewport, straight from the R-tree
+    try:
+        bbox = parse_bbox(request.args.get('bbox', ''))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    limit = min(request.args.get('limit', GEOJSON_MAX_PAGE_SIZE, type=int), GEOJSON_MAX_PAGE_SIZE)
+
+    conn = get_db()
+    routes = conn.execute(f"""SELECT id, start_address, end_address, distance, date FROM routes
+                              WHERE id IN ({RTREE_BBOX_QUERY}) ORDER BY id LIMIT ?""",
+                          (bbox[0], bbox[2], bbox[1], bbox[3], limit)).fetchall()
+    return jsonify([{
+        'id': route['id'],
+        'start': route['start_address'],
+        'end': route['end_address'],
+        'distance': route['distance'],
+        'date': route['date']
+    } for route in routes])
+
+@app.route('/get_nearest_routes')
+def get_nearest_routes():
+    # ?lat=&lon=&n=10&kind=start|end|any: routes starting/ending nearest a point
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    n = min(request.args.get('n', 10, type=int), GEOJSON_MAX_PAGE_SIZE)
+    kind = request.args.get('kind', 'any')
+    if lat is None or lon is None or kind not in ('start', 'end', 'any') or n < 1:
+        return jsonify({'success': False, 'error': 'lat, lon, n >= 1 and kind (start, end or any) are required'}), 400
+
+    conn = get_db()
+    matches = nearest_route_endpoints(conn, lat, lon, n, kind)
+    routes = {}
+    if matches:
+        ids = sorted({route_id for _, route_id, _ in matches})
+        placeholders = ','.join('?' * len(ids))
+        routes = {row['id']: row for row in conn.execute(
+            f"SELECT id, start_address, end_address, distance, date FROM routes WHERE id IN ({placeholders})", ids)}
+    return jsonify([{
+        'id': route_id,
+        'start': routes[route_id]['start_address'],
+        'end': routes[route_id]['end_address'],
+        'distance': routes[route_id]['distance'],
+        'date': routes[route_id]['date'],
+        'match': match_kind,
+        'distance_to_point_km': round(distance_km, 3)
+    } for distance_km, route_id, match_kind in matches if route_id in routes])
+
 @app.route('/get_statistics')
 def get_statistics():
+    # O(1) reads from the trigger-maintained aggregates
     conn = get_db()
-    
-    # Total routes
-    total_routes = conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
-    
-    # Total distance
-    total_distance = conn.execute("SELECT SUM(distance) FROM routes").fetchone()[0] or 0
-    
-    # Average distance
-    avg_distance = conn.execute("SELECT AVG(distance) FROM routes").fetchone()[0] or 0
-    
-    # Routes per day
-    daily_routes = dict(conn.execute("SELECT date, COUNT(*) FROM routes GROUP BY date ORDER BY date DESC").fetchall())
-    
-    conn.close()
+    stats = conn.execute("SELECT total_routes, distance_count, total_distance FROM routes_stats WHERE id = 1").fetchone()
+    daily_routes = dict(conn.execute("SELECT day, route_count FROM routes_daily_stats ORDER BY day DESC").fetchall())
+
+    total_routes = stats['total_routes'] if stats else 0
+    total_distance = stats['total_distance'] if stats and total_routes else 0
+    avg_distance = total_distance / stats['distance_count'] if stats and stats['distance_count'] else 0
     
     return jsonify({
         'total_routes': total_routes,
@@ -395,8 +3359,195 @@ def get_statistics():
         'daily_routes': daily_routes
     })
 
+statistics_breakdown_cache = {'version': None, 'data': None}
+statistics_breakdown_lock = threading.Lock()
+
+def compute_statistics_breakdown(conn):
+    routes = pd.read_sql_query("SELECT start_address, distance FROM routes WHERE distance IS NOT NULL", conn)
+    if routes.empty:
+        return {'percentiles': {}, 'by_start_address': []}
+
+    distances = routes['distance'].to_numpy()
+    quantiles = (10, 25, 50, 75, 90, 95, 99)
+    percentiles = dict(zip((f'p{q}' for q in quantiles), np.round(np.percentile(distances, quantiles), 2).tolist()))
+
+    by_start = (routes.groupby('start_address')['distance']
+                .agg(routes='count', total_distance='sum', average_distance='mean',
+                     median_distance='median', max_distance='max')
+                .sort_values('routes', ascending=False)
+                .head(STATISTICS_BREAKDOWN_LIMIT)
+                .round(2)
+                .reset_index())
+    return {
+        'percentiles': percentiles,
+        'by_start_address': json.loads(by_start.to_json(orient='records'))
+    }
+
+@app.route('/get_statistics_breakdown')
+def get_statistics_breakdown():
+    # Distance percentiles and per-start-address totals, computed with pandas
+    # on demand and cached until the next write to routes
+    conn = get_db()
+    version = conn.execute("SELECT version FROM routes_stats WHERE id = 1").fetchone()
+    version = version[0] if version else None
+    with statistics_breakdown_lock:
+        cached = statistics_breakdown_cache['version'] == version and statistics_breakdown_cache['data'] is not None
+        if not cached:
+            statistics_breakdown_cache.update({'version': version, 'data': compute_statistics_breakdown(conn)})
+        data = statistics_breakdown_cache['data']
+    return jsonify(dict(data, cached=cached))
+
+@app.route('/get_cache_stats')
+def get_cache_stats():
+    conn = get_db()
+    now = time.time()
+    geocode_rows = conn.execute("""SELECT COUNT(*) AS total,
+                                         SUM(lat IS NULL) AS negative,
+                                         SUM(expires_at <= ?) AS expired
+                                  FROM geocode_cache""", (now,)).fetchone()
+    route_rows = conn.execute("SELECT COUNT(*) AS total, SUM(computed_at <= ?) AS stale FROM route_cache",
+                              (now - ROUTE_CACHE_TTL,)).fetchone()
+
+    with cache_stats_lock:
+        geocode = dict(geocode_cache_stats)
+        route = dict(route_cache_stats)
+
+    hits = geocode['gazetteer_hits'] + geocode['memory_hits'] + geocode['db_hits'] + geocode['negative_hits']
+    lookups = hits + geocode['misses']
+    geocode.update({
+        'hit_ratio': round(hits / lookups, 4) if lookups else 0,
+        'memory_entries': len(geocode_memory_cache),
+        'stored_entries': geocode_rows['total'],
+        'stored_negative': geocode_rows['negative'] or 0,
+        'stored_expired': geocode_rows['expired'] or 0
+    })
+
+    lookups = route['hits'] + route['misses']
+    route.update({
+        'hit_ratio': round(route['hits'] / lookups, 4) if lookups else 0,
+        'stored_entries': route_rows['total'],
+        'stored_stale': route_rows['stale'] or 0
+    })
+
+    # Routes sharing a stored geometry: references above stored rows are
+    # blobs that didn't have to be written again
+    geometry_rows = conn.execute("SELECT COUNT(*) AS stored, SUM(refcount) AS refs FROM route_geometry").fetchone()
+    geometry = {'stored': geometry_rows['stored'], 'references': geometry_rows['refs'] or 0}
+    geometry['shared'] = geometry['references'] - geometry['stored']
+    return jsonify({'geocode': geocode, 'route': route, 'geometry': geometry})
+
+@app.route('/get_api_stats')
+def get_api_stats():
+    stats = {client.name: client.snapshot() for client in (opencage_client, graphhopper_client)}
+    stats['routing_backend'] = ROUTING_BACKEND
+    return jsonify(stats)
+
+@app.route('/metrics')
+def get_metrics():
+    # Prometheus text format: the registry plus cache and API client counters
+    counters = []
+    histograms = []
+    with cache_stats_lock:
+        for cache, stats in (('geocode', geocode_cache_stats), ('route', route_cache_stats)):
+            counters += [('cache_events_total', {'cache': cache, 'event': event}, value)
+                         for event, value in stats.items()]
+    for client in (opencage_client, graphhopper_client):
+        stats = client.snapshot()
+        counters += [('api_requests_total', {'provider': client.name, 'outcome': outcome}, stats[outcome])
+                     for outcome in ('requests', 'retries', 'failures', 'rate_limited')]
+        histograms.append(('api_request_seconds', {'provider': client.name},
+                           list(stats['latency_buckets'].values()), client.LATENCY_BUCKETS, stats['latency_sum']))
+    return Response(metrics.render(counters, histograms), mimetype='text/plain; version=0.0.4')
+
+@app.route('/clear_geocode_cache', methods=['POST'])
+def clear_geocode_cache():
+    # Only expired entries by default; pass ?all=1 to drop everything
+    conn = get_db()
+    if request.args.get('all'):
+        removed = conn.execute("DELETE FROM geocode_cache").rowcount
+        geocode_memory_cache.clear()
+    else:
+        removed = conn.execute("DELETE FROM geocode_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+    conn.commit()
+    return jsonify({'success': True, 'removed': removed})
+
+@app.route('/warm_route_cache', methods=['POST'])
+def warm_route_cache():
+    # Seed route_cache from existing rows. Endpoints are resolved through the
+    # geocode cache only, unless ?geocode=1 allows calling the API on a miss.
+    allow_geocode = bool(request.args.get('geocode'))
+    conn = get_db()
+    routes = conn.execute("""SELECT r.id, r.start_address, r.end_address, r.distance, r.date, g.route_points
+                             FROM routes r JOIN route_geometry g ON g.id = r.geometry_id
+                             WHERE r.route_key IS NULL""").fetchall()
+    warmed = 0
+    skipped = 0
+    for route in routes:
+        if allow_geocode:
+            start_coords = geocode_address(route['start_address'])
+            end_coords = geocode_address(route['end_address'])
+        else:
+            start_coords = lookup_cached_geocode(normalize_address(route['start_address']))[1]
+            end_coords = lookup_cached_geocode(normalize_address(route['end_address']))[1]
+        if not start_coords or not end_coords:
+            skipped += 1
+            continue
+
+        route_key = route_cache_key(start_coords, end_coords)
+        conn.execute("""INSERT OR IGNORE INTO route_cache
+                        (route_key, start_lat, start_lng, end_lat, end_lng, distance, route_points, computed_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (route_key, start_coords[0], start_coords[1], end_coords[0], end_coords[1],
+                      route['distance'], route['route_points'], parse_route_date(route['date'])))
+        conn.execute("UPDATE routes SET route_key = ? WHERE id = ?", (route_key, route['id']))
+        warmed += 1
+    conn.commit()
+    return jsonify({'success': True, 'warmed': warmed, 'skipped': skipped})
+
+@app.route('/refresh_stale_routes', methods=['POST'])
+def refresh_stale_routes():
+    # Re-route only cache entries older than ROUTE_CACHE_TTL and propagate the
+    # fresh distance/geometry to every route that references them
+    limit = request.args.get('limit', type=int) or -1
+    conn = get_db()
+    stale = conn.execute("""SELECT route_key, start_lat, start_lng, end_lat, end_lng FROM route_cache
+                            WHERE computed_at <= ? ORDER BY computed_at LIMIT ?""",
+                         (time.time() - ROUTE_CACHE_TTL, limit)).fetchall()
+
+    def refresh(entry):
+        return calculate_route([entry['start_lat'], entry['start_lng']],
+                               [entry['end_lat'], entry['end_lng']], refresh=True)
+
+    # Route everything first: the workers rewrite route_cache on their own
+    # connections, which an open write transaction here would block
+    cutoff = time.time() - ROUTE_CACHE_TTL
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        results = list(zip(stale, executor.map(refresh, stale)))
+
+    refreshed = 0
+    failed = 0
+    for entry, route_data in results:
+        # Only entries whose cache row was rewritten count; the rest stay
+        # stale and are picked up again by the next call
+        row = conn.execute("SELECT computed_at FROM route_cache WHERE route_key = ?",
+                           (entry['route_key'],)).fetchone()
+        if not route_data or row is None or row['computed_at'] <= cutoff:
+            failed += 1
+            continue
+        conn.execute("UPDATE routes SET distance = ? WHERE route_key = ?",
+                     (route_data['distance'], entry['route_key']))
+        geometry = prepare_route_geometry(route_data['points'])
+        for route in conn.execute("SELECT id FROM routes WHERE route_key = ?", (entry['route_key'],)).fetchall():
+            update_route_geometry(conn, route['id'], geometry)
+        refreshed += 1
+    conn.commit()
+    return jsonify({'success': True, 'refreshed': refreshed, 'failed': failed})
+
 @app.route('/upload_addresses', methods=['POST'])
 def upload_addresses():
+    # Queues the file as a background job and returns its id right away.
+    # Progress is available from /get_import_job/<id> or as SSE from
+    # /import_job_events/<id>.
     print("=== Starting address upload processing ===")
     
     try:
@@ -418,148 +3569,194 @@ def upload_addresses():
             print("Error: No start address provided")
             return jsonify({'type': 'error', 'error': 'Start address is required'})
 
-        # Create a temporary file to store the uploaded content
-        temp_file_path = os.path.join(os.path.dirname(__file__), 'temp_addresses.txt')
-        file.save(temp_file_path)
-
-        def generate():
-            try:
-                # Read addresses from saved file
-                with open(temp_file_path, 'r', encoding='utf-8') as f:
-                    addresses = [line.strip() for line in f if line.strip()]
-                
-                # Clean up temp file
-                try:
-                    os.remove(temp_file_path)
-                except:
-                    pass
-                
-                total = len(addresses)
-                print(f"Total addresses to process: {total}")
-                
-                successful = 0
-                
-                # Process start address first
-                try:
-                    print(f"Geocoding start address: {start_address}")
-                    start_coords = geocode_address(start_address)
-                    if not start_coords:
-                        print(f"Error geocoding start address: {start_address}")
-                        yield json.dumps({
-                            'type': 'error',
-                            'error': f'Could not geocode start address: {start_address}'
-                        }) + '\n'
-                        return
-                    print(f"Start address geocoded successfully: {start_coords}")
-                except Exception as e:
-                    print(f"Exception geocoding start address: {str(e)}")
-                    yield json.dumps({
-                        'type': 'error',
-                        'error': f'Error processing start address: {str(e)}'
-                    }) + '\n'
-                    return
-
-                # Process each destination address
-                for i, address in enumerate(addresses, 1):
-                    try:
-                        print(f"Processing address {i}/{total}: {address}")
-                        
-                        # Geocode the destination address
-                        coords = geocode_address(address)
-                        if not coords:
-                            print(f"Failed to geocode address: {address}")
-                            yield json.dumps({
-                                'type': 'progress',
-                                'progress': (i * 100) // total,
-                                'current': i,
-                                'total': total,
-                                'address': address,
-                                'success': False,
-                                'error': 'Could not geocode address'
-                            }) + '\n'
-                            continue
-
-                        print(f"Successfully geocoded address: {address} -> {coords}")
-                        
-                        # Calculate route
-                        route_data = calculate_route(start_coords, coords)
-                        if not route_data:
-                            print(f"Failed to calculate route for: {address}")
-                            yield json.dumps({
-                                'type': 'progress',
-                                'progress': (i * 100) // total,
-                                'current': i,
-                                'total': total,
-                                'address': address,
-                                'success': False,
-                                'error': 'Could not calculate route'
-                            }) + '\n'
-                            continue
-
-                        print(f"Successfully calculated route for: {address}")
-                        
-                        # Save to database
-                        route_points = route_data.get('points', [])
-                        distance = route_data.get('distance', 0)
-                        
-                        db = get_db()
-                        db.execute(
-                            'INSERT INTO routes (start_address, end_address, distance, date, route_points) VALUES (?, ?, ?, ?, ?)',
-                            (start_address, address, distance, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), json.dumps(route_points))
-                        )
-                        db.commit()
-                        db.close()
-                        
-                        successful += 1
-                        print(f"Successfully saved route to database for: {address}")
-                        
-                        yield json.dumps({
-                            'type': 'progress',
-                            'progress': (i * 100) // total,
-                            'current': i,
-                            'total': total,
-                            'address': address,
-                            'success': True
-                        }) + '\n'
-                        
-                    except Exception as e:
-                        print(f"Error processing address {address}: {str(e)}")
-                        yield json.dumps({
-                            'type': 'progress',
-                            'progress': (i * 100) // total,
-                            'current': i,
-                            'total': total,
-                            'address': address,
-                            'success': False,
-                            'error': str(e)
-                        }) + '\n'
-
-                print(f"Processing complete. {successful} successful out of {total}")
-                yield json.dumps({
-                    'type': 'complete',
-                    'successful': successful,
-                    'total': total
-                }) + '\n'
-                
-            except Exception as e:
-                print(f"Fatal error during processing: {str(e)}")
-                yield json.dumps({
-                    'type': 'error',
-                    'error': f'Error processing file: {str(e)}'
-                }) + '\n'
-                
-                # Clean up temp file in case of error
-                try:
-                    os.remove(temp_file_path)
-                except:
-                    pass
+        # mode=matrix fetches distances in batches and leaves geometry for the map to load
+        mode = request.form.get('mode', 'route')
+        if mode not in ('route', 'matrix'):
+            return jsonify({'type': 'error', 'error': 'mode must be route or matrix'})
 
-        return Response(generate(), mimetype='application/x-json-stream')
+        lines = io.TextIOWrapper(file.stream, encoding='utf-8', errors='replace')
+        job_id, total = create_import_job(get_db(), start_address, (line.strip() for line in lines if line.strip()), mode)
+        import_job_executor.submit(run_import_job, job_id)
+        print(f"Queued import job {job_id} with {total} addresses")
+        return jsonify({'type': 'queued', 'success': True, 'job_id': job_id, 'total': total}), 202
         
     except Exception as e:
         print(f"Unexpected error in upload_addresses: {str(e)}")
         return jsonify({'type': 'error', 'error': f'Unexpected error: {str(e)}'})
 
+@app.route('/get_import_jobs')
+def get_import_jobs():
+    jobs = get_db().execute("SELECT * FROM import_jobs ORDER BY created_at DESC LIMIT 50").fetchall()
+    return jsonify({'jobs': [import_job_summary(job) for job in jobs]})
+
+@app.route('/get_import_job/<job_id>')
+def get_import_job(job_id):
+    conn = get_db()
+    job = conn.execute("SELECT * FROM import_jobs WHERE id = ?", (job_id,)).fetchone()
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    failures = conn.execute("""SELECT line, address, error FROM import_job_items
+                               WHERE job_id = ? AND status = 'failed' ORDER BY line LIMIT ?""",
+                            (job_id, IMPORT_MAX_ERRORS)).fetchall()
+    return jsonify({**import_job_summary(job), 'failures': [dict(row) for row in failures]})
+
+@app.route('/import_job_events/<job_id>')
+def import_job_events(job_id):
+    # Server-sent events: a 'status' snapshot, then the job's progress
+    # messages until it completes, fails or is cancelled
+    listener = queue.Queue()
+    with import_job_lock:
+        import_job_subscribers.setdefault(job_id, []).append(listener)
+    job = get_db().execute("SELECT * FROM import_jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def unsubscribe():
+        with import_job_lock:
+            listeners = import_job_subscribers.get(job_id, [])
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                import_job_subscribers.pop(job_id, None)
+
+    if job is None:
+        unsubscribe()
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    summary = import_job_summary(job)
+
+    def generate():
+        try:
+            yield f"data: {json.dumps({'type': 'status', **summary})}\n\n"
+            if summary['status'] == 'completed':
+                yield f"data: {json.dumps({'type': 'complete', 'successful': summary['successful'], 'total': summary['total']})}\n\n"
+                return
+            if summary['status'] in ('failed', 'cancelled'):
+                yield f"data: {json.dumps({'type': 'error' if summary['status'] == 'failed' else 'cancelled', 'error': summary['error']})}\n\n"
+                return
+            while True:
+                try:
+                    message = listener.get(timeout=IMPORT_JOB_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(message)}\n\n"
+                if message['type'] in ('complete', 'error', 'cancelled'):
+                    return
+        finally:
+            unsubscribe()
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/cancel_import_job/<job_id>', methods=['POST'])
+def cancel_import_job(job_id):
+    conn = get_db()
+    cursor = conn.execute("""UPDATE import_jobs SET status = 'cancelled', updated_at = ?
+                             WHERE id = ? AND status IN ('queued', 'running')""", (time.time(), job_id))
+    conn.commit()
+    if not cursor.rowcount:
+        return jsonify({'success': False, 'error': 'Job is not queued or running'}), 409
+    with import_job_lock:
+        cancelled_import_jobs.add(job_id)
+        running = job_id in running_import_jobs
+    if not running:
+        # Still queued: no worker will report it, so tell listeners here
+        publish_import_job_event(job_id, {'type': 'cancelled'})
+    return jsonify({'success': True})
+
+@app.route('/resume_import_job/<job_id>', methods=['POST'])
+def resume_import_job(job_id):
+    # Picks a cancelled or failed job up from its last checkpoint
+    with import_job_lock:
+        if job_id in running_import_jobs:
+            return jsonify({'success': False, 'error': 'Job is still stopping, try again shortly'}), 409
+    conn = get_db()
+    cursor = conn.execute("""UPDATE import_jobs SET status = 'queued', error = NULL, updated_at = ?
+                             WHERE id = ? AND status IN ('cancelled', 'failed')""", (time.time(), job_id))
+    conn.commit()
+    if not cursor.rowcount:
+        return jsonify({'success': False, 'error': 'Only cancelled or failed jobs can be resumed'}), 409
+    with import_job_lock:
+        cancelled_import_jobs.discard(job_id)
+    import_job_executor.submit(run_import_job, job_id)
+    return jsonify({'success': True, 'job_id': job_id})
+
+@app.route('/import_routes', methods=['POST'])
+def import_routes():
+    # Bulk load of CSV or NDJSON rows, sent as a 'file' upload or as the raw
+    # request body. Columns: start_address, end_address and optionally
+    # distance, date, notes, start_lat/start_lng, end_lat/end_lng, route_points.
+    # With ?resolve=1, rows without geometry are geocoded/routed like uploads.
+    file = request.files.get('file')
+    file_format = request.args.get('format', '').lower()
+    if not file_format:
+        name = file.filename if file else ''
+        if name.endswith(('.ndjson', '.jsonl')) or 'json' in (request.mimetype or ''):
+            file_format = 'ndjson'
+        else:
+            file_format = 'csv'
+    if file_format not in ('csv', 'ndjson'):
+        return jsonify({'success': False, 'error': 'format must be csv or ndjson'}), 400
+    resolve = request.args.get('resolve', '').lower() in ('1', 'true', 'yes')
+
+    conn = get_db()
+    summary = {'rows': 0, 'inserted': 0, 'duplicates': 0, 'failed': 0}
+    errors = []
+    seen = set()
+    batch = []
+
+    def record_error(line_number, message):
+        summary['failed'] += 1
+        if len(errors) < IMPORT_MAX_ERRORS:
+            errors.append({'line': line_number, 'error': message})
+
+    def flush():
+        rows = batch[:]
+        batch.clear()
+        if resolve:
+            pending = [row for row in rows if row['points'] is None]
+            if pending:
+                rows = [row for row in rows if row['points'] is not None]
+                with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+                    for row, error in executor.map(resolve_import_row, pending):
+                        if error:
+                            record_error(row['line'], error)
+                        else:
+                            rows.append(row)
+        if rows:
+            inserted = insert_import_batch(conn, rows)
+            summary['inserted'] += inserted
+            summary['duplicates'] += len(rows) - inserted
+
+    try:
+        for line_number, record in iter_import_records(file.stream if file else request.stream, file_format):
+            summary['rows'] += 1
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                row = parse_import_record(record)
+            except ValueError as e:
+                record_error(line_number, str(e))
+                continue
+            key = (row['start_address'], row['end_address'], row['date'])
+            if key in seen:
+                summary['duplicates'] += 1
+                continue
+            seen.add(key)
+            row['line'] = line_number
+            batch.append(row)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush()
+        flush()
+    except (UnicodeDecodeError, csv.Error, sqlite3.Error) as e:
+        print(f"Import error: {e}")
+        conn.rollback()
+        return jsonify({'success': False, 'error': f'Import failed: {e}', 'errors': errors, **summary}), 400
+
+    print(f"Imported {summary['inserted']} of {summary['rows']} rows")
+    return jsonify({'success': True, 'errors': errors, **summary})
+
 if __name__ == '__main__':
     init_db()
+    # Under the debug reloader only the serving child process runs jobs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        resume_import_jobs()
     app.run(host='0.0.0.0', port=10000, debug=True)
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""Compare JSON route_points with the compact encoding used by app.py.
+
+    python benchmarks/bench_geometry.py --points 2000 --routes 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import encode_route_points, decode_route_points
+
+
+def road_like_geometry(points, rng):
+    # Random walk with ~5-50 m steps, rounded like GraphHopper output
+    start = np.array([rng.uniform(-120, -75), rng.uniform(30, 45)])
+    steps = rng.normal(0, 0.0003, size=(points, 2)) + rng.normal(0, 0.0002, size=2)
+    return np.round(start + np.cumsum(steps, axis=0), 6).tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=2000, help='vertices per route')
+    parser.add_argument('--routes', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    geometries = [road_like_geometry(args.points, rng) for _ in range(args.routes)]
+    as_json = [json.dumps(points) for points in geometries]
+    as_blob = [encode_route_points(points) for points in geometries]
+
+    started = time.perf_counter()
+    for value in as_json:
+        json.loads(value)
+    json_decode = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for value in as_blob:
+        decode_route_points(value)
+    blob_decode = time.perf_counter() - started
+
+    json_size = sum(len(value) for value in as_json)
+    blob_size = sum(len(value) for value in as_blob)
+    error = max(np.abs(decode_route_points(b) - np.asarray(g)).max() for b, g in zip(as_blob, geometries))
+
+    print(f'size    json {json_size / 1e6:8.2f} MB   compact {blob_size / 1e6:8.2f} MB   {json_size / blob_size:5.1f}x smaller')
+    print(f'decode  json {json_decode * 1e3:8.1f} ms   compact {blob_decode * 1e3:8.1f} ms   {json_decode / blob_decode:5.1f}x faster')
+    print(f'max round-trip error {error:.2e} degrees')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark the local routing engine on a synthetic road grid.
+
+Writes a jittered grid road network (with some streets removed and some
+one-way) as an edge-list CSV, loads it as the app would, and times A* and
+contraction-hierarchy queries against each other. Distances from both are
+checked against plain Dijkstra.
+
+    python benchmarks/bench_routing.py --size 150 --queries 200
+"""
+import argparse
+import csv
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_grid(path, size, seed=1):
+    # size x size intersections roughly 100 m apart around Springfield, IL
+    rng = random.Random(seed)
+    nodes = {(r, c): (39.78 + r * 0.0009 + rng.uniform(-0.0002, 0.0002),
+                      -89.65 + c * 0.0012 + rng.uniform(-0.0002, 0.0002))
+             for r in range(size) for c in range(size)}
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['from_lat', 'from_lon', 'to_lat', 'to_lon', 'oneway'])
+        for (r, c), (lat, lon) in nodes.items():
+            for neighbor in ((r + 1, c), (r, c + 1)):
+                if neighbor in nodes and rng.random() > 0.1:
+                    oneway = 1 if rng.random() < 0.15 else 0
+                    end = nodes[neighbor]
+                    if oneway and rng.random() < 0.5:
+                        writer.writerow([*end, lat, lon, oneway])
+                    else:
+                        writer.writerow([lat, lon, *end, oneway])
+    return list(nodes.values())
+
+
+def timed(func, pairs):
+    results, timings = [], []
+    for source, target in pairs:
+        started = time.perf_counter()
+        results.append(func(source, target))
+        timings.append((time.perf_counter() - started) * 1000)
+    return results, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=150, help='grid side length in intersections')
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    import app as app_module
+    app_module.print = lambda *a, **k: None
+
+    path = os.path.join(tempfile.mkdtemp(prefix='routemanager-graph-'), 'roads.csv')
+    write_grid(path, args.size)
+
+    started = time.perf_counter()
+    graph, _ = app_module.load_road_graph(path)
+    print(f'load      {time.perf_counter() - started:8.2f}s  {len(graph)} nodes  {len(graph.indices)} edges')
+    os.remove(path + '.npz')
+    started = time.perf_counter()
+    graph, hierarchy = app_module.load_road_graph(path, contract=True)
+    print(f'contract  {time.perf_counter() - started:8.2f}s  {len(hierarchy.shortcuts)} shortcuts')
+
+    rng = random.Random(2)
+    pairs = [(rng.randrange(len(graph)), rng.randrange(len(graph))) for _ in range(args.queries)]
+    reference = [graph.distances_from(source, [target]).get(target) for source, target in pairs]
+
+    for name, engine in (('astar', graph), ('ch', hierarchy)):
+        results, timings = timed(engine.shortest_path, pairs)
+        mismatches = sum(1 for result, expected in zip(results, reference)
+                         if (result is None) != (expected is None) or
+                         (result and abs(result[0] - expected) > 1e-3 * max(1.0, expected)))
+        timings.sort()
+        print(f'{name:<9} p50 {statistics.median(timings):7.3f} ms  p99 {timings[int(len(timings) * 0.99) - 1]:7.3f} ms  '
+              f'mismatches {mismatches}/{len(pairs)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""Time the main endpoints on synthetic databases and write a JSON report.
+
+Each dataset size runs in its own process against a fresh database of
+road-like routes, with OpenCage and GraphHopper replaced by the local stubs.
+Every operation goes through the Flask test client and reports p50/p99
+latency, throughput and the peak memory allocated while it ran (tracemalloc,
+measured on a separate untimed run). Reports from two commits can be compared:
+
+    python benchmarks/bench_suite.py --sizes 1000,10000,100000 --output report.json
+    python benchmarks/bench_suite.py --sizes 1000 --compare baseline.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_providers import StubServer
+
+DEPOTS = 20
+TOWNS = 50
+
+
+def synthetic_rows(count, points, rng, offset=0, repeat_share=0.0):
+    # Routes from a handful of depots, with random-walk geometry of roughly
+    # `points` vertices (~5-50 m steps) like GraphHopper output. repeat_share
+    # of the rows re-deliver to an earlier customer, with the same path.
+    first_day = datetime(2023, 1, 1)
+    rows = []
+    for i in range(offset, offset + count):
+        if rows and rng.random() < repeat_share:
+            earlier = rows[int(rng.integers(0, len(rows)))]
+            customer, path = earlier['customer'], earlier['points']
+        else:
+            vertices = max(2, int(rng.normal(points, points / 4)))
+            start = np.array([rng.uniform(-120, -75), rng.uniform(30, 45)])
+            steps = rng.normal(0, 0.0003, size=(vertices, 2)) + rng.normal(0, 0.0002, size=2)
+            customer, path = i, np.round(start + np.cumsum(steps, axis=0), 6)
+        rows.append({
+            'customer': customer,
+            'start_address': f'Depot {customer % DEPOTS}, Springfield',
+            'end_address': f'{customer} Customer Street, Town {customer % TOWNS}',
+            'distance': None,
+            'date': (first_day + timedelta(minutes=int(rng.integers(0, 2 * 365 * 24 * 60)))).strftime('%Y-%m-%d %H:%M:%S'),
+            'notes': f'Order {i}' if i % 3 == 0 else '',
+            'start': (float(path[0, 1]), float(path[0, 0])),
+            'end': (float(path[-1, 1]), float(path[-1, 0])),
+            'points': path
+        })
+    return rows
+
+
+def generate_dataset(app_module, size, points, seed, repeat_share):
+    rng = np.random.default_rng(seed)
+    conn = app_module.connect_db()
+    try:
+        for offset in range(0, size, 1000):
+            app_module.insert_import_batch(conn, synthetic_rows(min(1000, size - offset), points, rng, offset,
+                                                                repeat_share))
+    finally:
+        conn.close()
+
+
+def summarize(samples, peak):
+    milliseconds = np.array(samples) * 1000
+    return {
+        'samples': len(samples),
+        'p50_ms': round(float(np.percentile(milliseconds, 50)), 3),
+        'p99_ms': round(float(np.percentile(milliseconds, 99)), 3),
+        'mean_ms': round(float(milliseconds.mean()), 3),
+        'max_ms': round(float(milliseconds.max()), 3),
+        'throughput_per_s': round(len(samples) / float(np.sum(samples)), 2) if np.sum(samples) else None,
+        'peak_alloc_bytes': peak
+    }
+
+
+def measure(run, repeat, setup=None):
+    # Timed runs first, then one traced run for peak memory so tracemalloc's
+    # overhead stays out of the latencies
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - started)
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return summarize(samples, peak)
+
+
+def check(response):
+    if response.status_code != 200:
+        raise RuntimeError(f'{response.request.path} returned {response.status_code}')
+    return response
+
+
+def run_dataset(size, args):
+    stub = StubServer(latency=args.latency).start()
+    os.environ.update(stub.env())
+    workdir = tempfile.mkdtemp(prefix='routemanager-suite-')
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'routes.db')
+
+    import app as app_module
+    app_module.print = lambda *a, **k: None  # keep per-row logging out of the timings
+    app_module.app.config['UPLOAD_FOLDER'] = workdir
+    app_module.MAP_CACHE_FILE = os.path.join(workdir, 'cached_map.html')
+    app_module.MAP_CACHE_META_FILE = os.path.join(workdir, 'map_last_update.txt')
+    app_module.init_db()
+    client = app_module.app.test_client()
+
+    started = time.perf_counter()
+    generate_dataset(app_module, size, args.points, args.seed, args.repeat_share)
+    generate_seconds = time.perf_counter() - started
+
+    def reset_map_cache():
+        app_module.map_cache.update({'token': None, 'version': 0, 'level': None, 'html_token': None, 'html': None})
+        app_module.map_cache['fragments'].clear()
+        if os.path.exists(app_module.MAP_CACHE_FILE):
+            os.remove(app_module.MAP_CACHE_FILE)
+
+    extra_rows = iter(synthetic_rows(args.repeat + 1, args.points, np.random.default_rng(args.seed + 1), offset=size))
+
+    def add_one_route():
+        conn = app_module.connect_db()
+        try:
+            app_module.insert_import_batch(conn, [next(extra_rows)])
+        finally:
+            conn.close()
+
+    def export_all():
+        # Consume the stream so the whole export is timed, not just the first chunk
+        response = check(client.get('/export_csv'))
+        for _ in response.response:
+            pass
+        response.close()
+
+    uploads = iter(range(args.repeat + 1))
+
+    def upload_addresses():
+        batch = next(uploads)
+        payload = '\n'.join(f'{i} Upload Lane {batch}, Town {i % TOWNS}' for i in range(args.upload_addresses))
+        response = client.post('/upload_addresses', data={
+            'file': (io.BytesIO(payload.encode('utf-8')), 'addresses.txt'),
+            'startAddress': 'Depot 0, Springfield'
+        }, content_type='multipart/form-data')
+        job_id = response.get_json()['job_id']
+        # The event stream ends once the background job finishes
+        events = client.get(f'/import_job_events/{job_id}').get_data(as_text=True)
+        last = json.loads([line for line in events.splitlines() if line.startswith('data: ')][-1][len('data: '):])
+        if last.get('type') != 'complete':
+            raise RuntimeError(f'Upload did not complete: {last}')
+
+    heavy = max(1, args.repeat // 5)
+    operations = {}
+    # The first map build also creates every route's levels of detail
+    started = time.perf_counter()
+    check(client.get('/get_map'))
+    operations['get_map_first'] = summarize([time.perf_counter() - started], None)
+
+    operations['get_routes'] = measure(lambda: check(client.get('/get_routes')), args.repeat)
+    operations['get_routes_search'] = measure(lambda: check(client.get('/get_routes?q=Town 7&sort=distance')), args.repeat)
+    operations['get_map'] = measure(lambda: check(client.get('/get_map')), args.repeat)
+    operations['get_map_cold'] = measure(lambda: check(client.get('/get_map')), heavy, setup=reset_map_cache)
+    operations['get_map_incremental'] = measure(lambda: check(client.get('/get_map')), heavy, setup=add_one_route)
+    operations['get_statistics'] = measure(lambda: check(client.get('/get_statistics')), args.repeat)
+    operations['export_csv'] = measure(export_all, heavy)
+    operations['backup_database'] = measure(lambda: check(client.post('/backup_database')), heavy)
+    operations['upload_addresses'] = measure(upload_addresses, heavy)
+    operations['upload_addresses']['rows_per_s'] = round(
+        operations['upload_addresses']['throughput_per_s'] * args.upload_addresses, 1)
+
+    stub.shutdown()
+    return {
+        'routes': size,
+        'generate_seconds': round(generate_seconds, 2),
+        'database_bytes': os.path.getsize(app_module.DATABASE_PATH),
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'operations': operations
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, report, threshold):
+    # Prints p50 ratios per operation; returns the regressions beyond threshold
+    regressions = []
+    for size, dataset in report['datasets'].items():
+        base = baseline['datasets'].get(size)
+        if not base:
+            continue
+        for name, result in dataset['operations'].items():
+            before = base['operations'].get(name)
+            if not before or not before['p50_ms']:
+                continue
+            ratio = result['p50_ms'] / before['p50_ms']
+            flag = ' REGRESSION' if ratio > threshold else ''
+            print(f'{size:>7} {name:<22} {before["p50_ms"]:10.2f} -> {result["p50_ms"]:10.2f} ms  x{ratio:5.2f}{flag}')
+            if flag:
+                regressions.append((size, name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma-separated route counts')
+    parser.add_argument('--points', type=int, default=200, help='average vertices per route')
+    parser.add_argument('--repeat-share', type=float, default=0.0,
+                        help='share of routes repeating an earlier start/end pair (within each 1000-row batch)')
+    parser.add_argument('--repeat', type=int, default=20, help='samples per light operation')
+    parser.add_argument('--upload-addresses', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.01, help='stub response delay in seconds')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--compare', help='baseline report to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2, help='p50 ratio counted as a regression')
+    parser.add_argument('--dataset', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.dataset is not None:
+        # Child process: one dataset, report on stdout
+        print(json.dumps(run_dataset(args.dataset, args)))
+        return
+
+    report = {
+        'commit': git_commit(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'settings': {key: getattr(args, key) for key in ('points', 'repeat_share', 'repeat', 'upload_addresses', 'latency', 'seed')},
+        'datasets': {}
+    }
+    for size in (int(value) for value in args.sizes.split(',')):
+        # A fresh process per size keeps caches and peak RSS independent
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--dataset', str(size),
+                                *(f'--{key.replace("_", "-")}={value}' for key, value in report['settings'].items())],
+                               stdout=subprocess.PIPE, text=True, check=True)
+        dataset = json.loads(child.stdout.strip().splitlines()[-1])
+        report['datasets'][str(size)] = dataset
+        print(f'{size} routes: generated in {dataset["generate_seconds"]}s, '
+              f'{dataset["database_bytes"] / 1e6:.1f} MB, peak RSS {dataset["max_rss_bytes"] / 1e6:.0f} MB')
+        for name, result in dataset['operations'].items():
+            peak = f'{result["peak_alloc_bytes"] / 1e6:8.1f} MB' if result['peak_alloc_bytes'] is not None else ''
+            print(f'  {name:<22} p50 {result["p50_ms"]:10.2f} ms  p99 {result["p99_ms"]:10.2f} ms  '
+                  f'{result["throughput_per_s"]:9.1f}/s {peak}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Report written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'Compared with {args.compare} (commit {baseline.get("commit")}):')
+        if compare(baseline, report, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
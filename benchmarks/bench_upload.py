@@ -0,0 +1,95 @@
+"""Benchmark /upload_addresses jobs against the local provider stubs.
+
+Runs the same import with a single worker (the old sequential behaviour) and
+with the configured pool size, then prints the timings and speedup. Finally
+compares per-destination routing with the one-to-many matrix mode.
+
+    python benchmarks/bench_upload.py --addresses 500 --latency 0.05 --workers 16
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_providers import StubServer
+
+
+def run_upload(app_module, addresses, workers, cold=True, mode='route'):
+    app_module.UPLOAD_WORKERS = workers
+    client = app_module.app.test_client()
+    if cold:
+        # Start each run cold so the comparison measures the pipeline, not the cache
+        client.post('/clear_geocode_cache?all=1')
+    payload = '\n'.join(addresses).encode('utf-8')
+
+    started = time.perf_counter()
+    response = client.post('/upload_addresses', data={
+        'file': (io.BytesIO(payload), 'addresses.txt'),
+        'startAddress': 'Depot 1, Springfield',
+        'mode': mode
+    }, content_type='multipart/form-data')
+    job_id = response.get_json()['job_id']
+    # The event stream ends once the background job finishes
+    events = client.get(f'/import_job_events/{job_id}').get_data(as_text=True)
+    messages = [json.loads(line[len('data: '):]) for line in events.splitlines() if line.startswith('data: ')]
+    elapsed = time.perf_counter() - started
+
+    complete = messages[-1]
+    if complete.get('type') != 'complete':
+        raise RuntimeError(f'Upload did not complete: {complete}')
+    return elapsed, complete['successful']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--addresses', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help='stub response delay in seconds')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    stub = StubServer(latency=args.latency).start()
+    os.environ.update(stub.env())
+
+    workdir = tempfile.mkdtemp(prefix='routemanager-bench-')
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'routes.db')
+    import app as app_module
+    app_module.print = lambda *a, **k: None  # keep per-row logging out of the timings
+    app_module.init_db()
+
+    addresses = [f'{i} Customer Street, Town {i % 50}' for i in range(args.addresses)]
+
+    results = {}
+    for workers in (1, args.workers):
+        elapsed, successful = run_upload(app_module, addresses, workers)
+        results[workers] = elapsed
+        print(f'workers={workers:<3} {elapsed:8.2f}s  {successful}/{len(addresses)} routes  '
+              f'{len(addresses) / elapsed:8.1f} rows/s')
+
+    print(f'speedup: {results[1] / results[args.workers]:.1f}x')
+
+    # Warm re-import of the same file is served from the geocode cache
+    elapsed, successful = run_upload(app_module, addresses, args.workers, cold=False)
+    print(f'warm re-import {elapsed:8.2f}s  {successful}/{len(addresses)} routes')
+
+    # Per-destination routing vs. one-to-many matrix calls, with a cold route cache
+    for mode in ('route', 'matrix'):
+        conn = app_module.connect_db()
+        conn.execute('DELETE FROM route_cache')
+        conn.commit()
+        conn.close()
+        calls, sent = dict(stub.calls), dict(stub.bytes_sent)
+        elapsed, successful = run_upload(app_module, addresses, args.workers, cold=False, mode=mode)
+        routing = ('/api/1/route', '/api/1/matrix')
+        print(f'mode={mode:<7} {elapsed:8.2f}s  {successful}/{len(addresses)} routes  '
+              f'routing calls={sum(stub.calls.get(p, 0) - calls.get(p, 0) for p in routing)}  '
+              f'routing bytes={sum(stub.bytes_sent.get(p, 0) - sent.get(p, 0) for p in routing)}')
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
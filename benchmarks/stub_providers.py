@@ -0,0 +1,126 @@
+"""Local stand-ins for the OpenCage and GraphHopper HTTP APIs.
+
+The stubs answer with deterministic, plausible payloads after a configurable
+delay so benchmarks measure the app rather than the network.
+"""
+import hashlib
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def fake_coords(address):
+    # Spread addresses deterministically over the continental US
+    digest = hashlib.sha1(address.encode('utf-8')).digest()
+    lat = 30.0 + (int.from_bytes(digest[:4], 'big') / 2**32) * 15.0
+    lng = -120.0 + (int.from_bytes(digest[4:8], 'big') / 2**32) * 45.0
+    return lat, lng
+
+
+def fake_path(start, end, points=200):
+    # Straight line with a little wobble, as [lon, lat] pairs like GraphHopper
+    coords = []
+    for i in range(points):
+        t = i / (points - 1)
+        lat = start[0] + (end[0] - start[0]) * t + 0.01 * math.sin(t * 40)
+        lon = start[1] + (end[1] - start[1]) * t + 0.01 * math.cos(t * 40)
+        coords.append([round(lon, 6), round(lat, 6)])
+    return coords
+
+
+def haversine_m(start, end):
+    lat1, lon1, lat2, lon2 = map(math.radians, (start[0], start[1], end[0], end[1]))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371000 * 2 * math.asin(math.sqrt(a))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server_version = 'StubProviders/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        time.sleep(self.server.latency)
+        self.server.count(parsed.path)
+
+        if parsed.path == '/geocode/v1/json':
+            address = query.get('q', [''])[0]
+            if not address or address.startswith('UNKNOWN'):
+                body = {'results': []}
+            else:
+                lat, lng = fake_coords(address)
+                body = {'results': [{'geometry': {'lat': lat, 'lng': lng}}]}
+        elif parsed.path == '/api/1/route':
+            points = [tuple(map(float, p.split(','))) for p in query.get('point', [])]
+            if len(points) < 2:
+                self.send_error(400)
+                return
+            body = {'paths': [{
+                'distance': haversine_m(points[0], points[-1]) * 1.3,
+                'points': {'coordinates': fake_path(points[0], points[-1], self.server.route_points)}
+            }]}
+        elif parsed.path == '/api/1/matrix':
+            # One-to-many distances in metres, consistent with /api/1/route
+            sources = [tuple(map(float, p.split(','))) for p in query.get('from_point', [])]
+            targets = [tuple(map(float, p.split(','))) for p in query.get('to_point', [])]
+            if not sources or not targets:
+                self.send_error(400)
+                return
+            body = {'distances': [[round(haversine_m(source, target) * 1.3) for target in targets]
+                                  for source in sources]}
+        else:
+            self.send_error(404)
+            return
+
+        payload = json.dumps(body).encode('utf-8')
+        self.server.count_bytes(parsed.path, len(payload))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, route_points=200, port=0):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.latency = latency
+        self.route_points = route_points
+        self.calls = {}
+        self.bytes_sent = {}
+        self._lock = threading.Lock()
+
+    def count(self, path):
+        with self._lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+
+    def count_bytes(self, path, size):
+        with self._lock:
+            self.bytes_sent[path] = self.bytes_sent.get(path, 0) + size
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def env(self):
+        # Environment variables that point app.py at this server, with the
+        # client-side rate limiters disabled
+        return {
+            'OPENCAGE_URL': f'{self.base_url}/geocode/v1/json',
+            'GRAPHHOPPER_URL': f'{self.base_url}/api/1/route',
+            'GRAPHHOPPER_MATRIX_URL': f'{self.base_url}/api/1/matrix',
+            'OPENCAGE_RATE_LIMIT': '0',
+            'GRAPHHOPPER_RATE_LIMIT': '0',
+        }
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
@@ -6,6 +6,8 @@
             column: 'date',
             direction: 'desc'
         };
+        let routesCursor = null;
+        let routesQuery = '';
 
         // Load initial data
         loadRoutes();
@@ -129,6 +131,7 @@
             const formData = new FormData();
             formData.append('file', fileInput.files[0]);
             formData.append('startAddress', startAddress);
+            formData.append('mode', $('#uploadMatrixMode').is(':checked') ? 'matrix' : 'route');
             
             console.log('FormData created with file and start address');
             
@@ -149,121 +152,143 @@
             submitButton.prop('disabled', true);
             submitButton.html('<span class="spinner-border spinner-border-sm" role="status" aria-hidden="true"></span> Processing...');
             
-            console.log('Starting fetch request to /upload_addresses');
+            console.log('Submitting upload job to /upload_addresses');
             
-            // Create fetch request with streaming response
             fetch('/upload_addresses', {
                 method: 'POST',
                 body: formData
             })
-            .then(response => {
-                console.log('Received initial response:', response.status, response.statusText);
-                const reader = response.body.getReader();
-                const decoder = new TextDecoder();
-                
-                function processStream({ done, value }) {
-                    if (done) {
-                        console.log('Stream processing complete');
-                        submitButton.prop('disabled', false);
-                        submitButton.html('Upload and Process');
-                        return;
-                    }
-                    
-                    // Process chunks of data
-                    const chunk = decoder.decode(value);
-                    console.log('Received chunk:', chunk);
-                    
-                    const lines = chunk.split('\n');
-                    
-                    lines.forEach(line => {
-                        if (!line) return;
-                        
-                        try {
-                            console.log('Processing line:', line);
-                            const data = JSON.parse(line);
-                            console.log('Parsed data:', data);
-                            
-                            if (data.type === 'progress') {
-                                console.log('Progress update:', data.progress + '%', data.current + '/' + data.total);
-                                // Update progress bar and counts
-                                progressBar.css('width', data.progress + '%');
-                                $('#processCount').text(`${data.current}/${data.total}`);
-                                $('#currentAddress').text(`Processing: ${data.address}`);
-                                
-                                // Add to processing log
-                                const logEntry = $('<div>').addClass('mb-1');
-                                if (data.success) {
-                                    logEntry.addClass('text-success')
-                                           .html(`✓ ${data.address}`);
-                                } else {
-                                    logEntry.addClass('text-danger')
-                                           .html(`✗ ${data.address} - ${data.error}`);
-                                }
-                                processingLog.prepend(logEntry);
-                                processingLog.scrollTop(0);
-                            }
-                            else if (data.type === 'complete') {
-                                console.log('Processing complete:', data);
-                                const successful = data.successful;
-                                const total = data.total;
-                                
-                                $('#uploadStatus').html(`
-                                    <div class="alert alert-success">
-                                        Successfully processed ${successful} out of ${total} destinations.
-                                        ${successful < total ? `<br>Some destinations failed - see log above for details.` : ''}
-                                    </div>
-                                `);
-                                
-                                $('#currentAddress').text('Processing complete');
-                                $('#processCount').text(`${successful}/${total} successful`);
-                                
-                                loadRoutes();
-                                updateMap();
-                                updateStatistics();
-                                
-                                setTimeout(() => {
-                                    fileInput.value = '';
-                                    $('#uploadStartAddress').val('');
-                                    $('#uploadProgress').addClass('d-none');
-                                    progressBar.css('width', '0%');
-                                    submitButton.prop('disabled', false);
-                                    submitButton.html('Upload and Process');
-                                }, 5000);
-                            }
-                            else if (data.type === 'error') {
-                                console.error('Server reported error:', data.error);
-                                $('#uploadStatus').html(`
-                                    <div class="alert alert-danger">
-                                        Error: ${data.error}
-                                    </div>
-                                `);
-                                $('#uploadProgress').addClass('d-none');
-                                submitButton.prop('disabled', false);
-                                submitButton.html('Upload and Process');
-                            }
-                        } catch (e) {
-                            console.error('Error parsing response line:', e, line);
-                        }
-                    });
-                    
-                    return reader.read().then(processStream);
+            .then(response => response.json())
+            .then(data => {
+                console.log('Upload job response:', data);
+                if (data.type === 'error' || !data.job_id) {
+                    showUploadError(data.error || 'Could not start upload');
+                    return;
                 }
-                
-                return reader.read().then(processStream);
+                // Remember the job so a refresh can reattach to its progress
+                localStorage.setItem('uploadJobId', data.job_id);
+                watchUploadJob(data.job_id);
             })
             .catch(error => {
                 console.error('Fetch error:', error);
-                $('#uploadStatus').html(`
-                    <div class="alert alert-danger">
-                        Error uploading file. Please try again.
-                    </div>
-                `);
-                $('#uploadProgress').addClass('d-none');
-                submitButton.prop('disabled', false);
-                submitButton.html('Upload and Process');
+                showUploadError('Error uploading file. Please try again.');
             });
         });
 
+        function resetUploadButton() {
+            const submitButton = $('#uploadAddressesForm').find('button[type="submit"]');
+            submitButton.prop('disabled', false);
+            submitButton.html('Upload and Process');
+        }
+
+        function showUploadError(error) {
+            $('#uploadStatus').html(`
+                <div class="alert alert-danger">
+                    Error: ${error}
+                </div>
+            `);
+            $('#uploadProgress').addClass('d-none');
+            resetUploadButton();
+        }
+
+        // Follow a background upload job over server-sent events
+        function watchUploadJob(jobId) {
+            const progressBar = $('#uploadProgress .progress-bar');
+            const processingLog = $('#processingLog');
+            const submitButton = $('#uploadAddressesForm').find('button[type="submit"]');
+            $('#uploadProgress').removeClass('d-none');
+            submitButton.prop('disabled', true);
+            submitButton.html('<span class="spinner-border spinner-border-sm" role="status" aria-hidden="true"></span> Processing...');
+
+            const events = new EventSource(`/import_job_events/${jobId}`);
+            let lastRefresh = 0;
+
+            function finish() {
+                events.close();
+                localStorage.removeItem('uploadJobId');
+            }
+
+            events.onmessage = function(event) {
+                const data = JSON.parse(event.data);
+
+                if (data.type === 'status') {
+                    progressBar.css('width', data.progress + '%');
+                    $('#processCount').text(`${data.processed}/${data.total}`);
+                }
+                else if (data.type === 'progress') {
+                    // Update progress bar and counts
+                    progressBar.css('width', data.progress + '%');
+                    $('#processCount').text(`${data.current}/${data.total}`);
+                    $('#currentAddress').text(`Processing: ${data.address}`);
+                    
+                    // Add to processing log
+                    const logEntry = $('<div>').addClass('mb-1');
+                    if (data.success) {
+                        logEntry.addClass('text-success')
+                               .text(`✓ ${data.address}`);
+                    } else {
+                        logEntry.addClass('text-danger')
+                               .text(`✗ ${data.address} - ${data.error}`);
+                    }
+                    processingLog.prepend(logEntry);
+                    processingLog.scrollTop(0);
+
+                    // Show committed routes while the job runs, at most every few seconds
+                    if (data.success && Date.now() - lastRefresh > 5000) {
+                        lastRefresh = Date.now();
+                        loadRoutes();
+                    }
+                }
+                else if (data.type === 'complete') {
+                    console.log('Processing complete:', data);
+                    finish();
+                    const successful = data.successful;
+                    const total = data.total;
+                    
+                    $('#uploadStatus').html(`
+                        <div class="alert alert-success">
+                            Successfully processed ${successful} out of ${total} destinations.
+                            ${successful < total ? `<br>Some destinations failed - see log above for details.` : ''}
+                        </div>
+                    `);
+                    
+                    $('#currentAddress').text('Processing complete');
+                    $('#processCount').text(`${successful}/${total} successful`);
+                    
+                    loadRoutes();
+                    updateMap();
+                    updateStatistics();
+                    
+                    setTimeout(() => {
+                        $('#addressFile').val('');
+                        $('#uploadStartAddress').val('');
+                        $('#uploadProgress').addClass('d-none');
+                        progressBar.css('width', '0%');
+                        resetUploadButton();
+                    }, 5000);
+                }
+                else if (data.type === 'error' || data.type === 'cancelled') {
+                    console.error('Upload job stopped:', data);
+                    finish();
+                    showUploadError(data.error || 'Upload was cancelled');
+                }
+            };
+
+            events.onerror = function() {
+                // EventSource reconnects on its own; a missing job will not come back
+                if (events.readyState === EventSource.CLOSED) {
+                    finish();
+                    resetUploadButton();
+                }
+            };
+        }
+
+        // Reattach to an upload that was still running when the page was left
+        const pendingUploadJob = localStorage.getItem('uploadJobId');
+        if (pendingUploadJob) {
+            watchUploadJob(pendingUploadJob);
+        }
+
         // ... rest of the code remains the same ...
 
         function kmToMiles(km) {
@@ -281,34 +306,27 @@
             return distanceUnit === 'miles' ? 'mi' : 'km';
         }
 
-        function loadRoutes() {
-            $.get('/get_routes', function(routes) {
+        function loadRoutes(append) {
+            // Sorting, filtering and paging happen server-side; append adds the next page
+            const params = {
+                sort: currentSort.column,
+                direction: currentSort.direction,
+                limit: 100
+            };
+            if (routesQuery) {
+                params.q = routesQuery;
+            }
+            if (append && routesCursor) {
+                params.cursor = routesCursor;
+            }
+            
+            $.get('/get_routes', params, function(page) {
                 const tbody = $('#routesList');
-                tbody.empty();
-                
-                // Sort routes based on current sort settings
-                routes.sort((a, b) => {
-                    let aVal = a[currentSort.column];
-                    let bVal = b[currentSort.column];
-                    
-                    // Handle numeric values
-                    if (currentSort.column === 'distance') {
-                        aVal = parseFloat(aVal);
-                        bVal = parseFloat(bVal);
-                    }
-                    
-                    // Handle date values
-                    if (currentSort.column === 'date') {
-                        aVal = new Date(aVal);
-                        bVal = new Date(bVal);
-                    }
-                    
-                    if (aVal < bVal) return currentSort.direction === 'asc' ? -1 : 1;
-                    if (aVal > bVal) return currentSort.direction === 'asc' ? 1 : -1;
-                    return 0;
-                });
+                if (!append) {
+                    tbody.empty();
+                }
 
-                routes.forEach(function(route) {
+                page.routes.forEach(function(route) {
                     const row = $('<tr>');
                     row.append($('<td>').text(route.start));
                     row.append($('<td>').text(route.end));
@@ -331,9 +349,27 @@
                     
                     tbody.append(row);
                 });
+                
+                routesCursor = page.next_cursor;
+                $('#loadMoreRoutes').toggleClass('d-none', !routesCursor);
             });
         }
 
+        $('#loadMoreRoutes').click(function() {
+            loadRoutes(true);
+        });
+
+        // Debounce the filter box so typing doesn't fire a request per key
+        let routesFilterTimer = null;
+        $('#routesFilter').on('input', function() {
+            clearTimeout(routesFilterTimer);
+            const value = $(this).val().trim();
+            routesFilterTimer = setTimeout(function() {
+                routesQuery = value;
+                loadRoutes();
+            }, 300);
+        });
+
         function updateMap() {
             console.log("Updating map...");
             fetch('/get_map')